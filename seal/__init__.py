@@ -91,3 +91,4 @@ def inject_config():
 from seal import routes
 from seal import schedulers
 from seal import admin
+from seal import commands
@@ -27,9 +27,11 @@ from flask_admin.contrib.sqla import ModelView
 from flask_login import current_user
 
 from seal import app, db, bcrypt
+from seal.cache import variants_cache
 from seal.models import (User, Team, Sample, Family, Variant, Comment_variant,
                          Comment_sample, Var2Sample, Filter, Transcript, Run,
-                         Region, Bed, Phenotype, Omim, History, Clinvar)
+                         Region, Bed, Phenotype, Omim, History, Clinvar,
+                         Occurrence)
 
 ###############################################################################
 
@@ -173,9 +175,37 @@ class SampleView(CustomView):
         None
 
     Methods:
+        update_model(form, model): Updates the specified sample and the
+                                   occurrences of its variants.
         delete_model(model): Deletes the specified sample and associated data
                              from the database.
     """
+    def update_model(self, form, model):
+        """
+        Updates a sample model, and the occurrences of its variants if its
+        status, affected state or teams changed.
+
+        Args:
+            form: The form with the new values.
+            model: The model to update.
+
+        Returns:
+            bool: True if the model was updated successfully, False otherwise.
+        """
+        old_state = Occurrence.sample_state(model)
+        if not super().update_model(form, model):
+            return False
+        try:
+            Occurrence.update_sample(model, old_state)
+            self.session.commit()
+            variants_cache.invalidate()
+        except Exception as ex:
+            flash(f'Failed to update occurrences: {ex} (Please contact the admin)', 'error')
+            app.logger.exception(f'Failed to update occurrences: {ex}')
+            self.session.rollback()
+            return False
+        return True
+
     def delete_model(self, model):
         """
         Deletes a sample model.
@@ -189,9 +219,12 @@ class SampleView(CustomView):
         try:
             self.session.flush()
 
-            var2samples = db.session.query(Var2Sample).filter(Var2Sample.sample_ID == int(model.id))
-            for var2sample in var2samples:
-                self.session.delete(var2sample)
+            Occurrence.count_sample(model, -1)
+            # One statement, in the partition of the sample
+            self.session.query(Var2Sample).filter(
+                Var2Sample.sample_ID == model.id
+            ).delete(synchronize_session=False)
+            self.session.expire(model, ["variants"])
 
             historical = db.session.query(History).filter(History.sample_ID == int(model.id))
             for history in historical:
@@ -199,6 +232,7 @@ class SampleView(CustomView):
 
             self.session.delete(model)
             self.session.commit()
+            variants_cache.invalidate()
         except Exception as ex:
             flash(f'Failed to delete record: {ex} (Please contact the admin)', 'error')
             app.logger.exception(f'Failed to delete record: {ex}')
@@ -260,6 +294,129 @@ class UserView(CustomView):
         return super(UserView, self).validate_form(form)
 
 
+class Var2SampleView(CustomView):
+    """
+    Custom class for Flask-Admin ModelView for the Var2Sample model.
+
+    Methods:
+        on_model_change(form, model, is_created): Marks the variant as changed
+                                                  in the samples of the family
+                                                  and counts a new occurrence.
+        after_model_change(form, model, is_created): Invalidates the cached
+                                                     variants of the family.
+        on_model_delete(model): Removes the occurrence of the variant in the
+                                sample.
+        after_model_delete(model): Invalidates the cached variants of the
+                                   family.
+    """
+    @staticmethod
+    def family_ids(model):
+        """
+        Get the samples showing a variant of a sample: the sample and its
+        relatives, which show its genotype.
+
+        Args:
+            model: The Var2Sample model object.
+
+        Returns:
+            set: The IDs of the samples.
+        """
+        sample = Sample.query.get(model.sample_ID)
+        sample_ids = {model.sample_ID}
+        if sample is not None and sample.family is not None:
+            sample_ids.update(s.id for s in sample.family.samples)
+        return sample_ids
+
+    def on_model_change(self, form, model, is_created):
+        """
+        Marks the variant as changed (see `Var2Sample.touch`) for the samples
+        of the family, for their tables to fetch it again. A created row is
+        counted in the occurrences of the variant.
+
+        Args:
+            form: The form object.
+            model: The Var2Sample model object.
+            is_created: Boolean indicating whether the row is being created or modified.
+        """
+        if is_created:
+            db.session.flush()
+            sample = Sample.query.get(model.sample_ID)
+            Occurrence.count_sample(sample, 1, variant_keys=[model.variant_key])
+        Var2Sample.touch(
+            Var2Sample.variant_key == model.variant_key,
+            Var2Sample.sample_ID.in_(self.family_ids(model))
+        )
+
+    def on_model_delete(self, model):
+        """
+        Removes the sample from the occurrences of the variant, while its row
+        still exists.
+
+        Args:
+            model: The Var2Sample model object being deleted.
+        """
+        sample = Sample.query.get(model.sample_ID)
+        Occurrence.count_sample(sample, -1, variant_keys=[model.variant_key])
+
+    def after_model_change(self, form, model, is_created):
+        """
+        Invalidates the cached variants of the samples of the family.
+
+        Args:
+            form: The form object.
+            model: The Var2Sample model object.
+            is_created: Boolean indicating whether the row is being created or modified.
+        """
+        variants_cache.invalidate(self.family_ids(model))
+
+    def after_model_delete(self, model):
+        """
+        Invalidates the cached variants of the samples of the family.
+
+        Args:
+            model: The deleted Var2Sample model object.
+        """
+        variants_cache.invalidate(self.family_ids(model))
+
+
+class VariantView(CustomView):
+    """
+    Custom class for Flask-Admin ModelView for the Variant model.
+
+    Methods:
+        on_model_change(form, model, is_created): Marks the variant as changed
+                                                  in the samples carrying it.
+        after_model_change(form, model, is_created): Invalidates the cached
+                                                     variants of these samples.
+    """
+    def on_model_change(self, form, model, is_created):
+        """
+        Marks the variant as changed (see `Var2Sample.touch`) in the samples
+        carrying it, for their tables to fetch it again.
+
+        Args:
+            form: The form object.
+            model: The Variant model object.
+            is_created: Boolean indicating whether the variant is being created or modified.
+        """
+        if not is_created:
+            Var2Sample.touch(Var2Sample.variant_key == model.key)
+
+    def after_model_change(self, form, model, is_created):
+        """
+        Invalidates the cached variants of the samples carrying the variant.
+
+        Args:
+            form: The form object.
+            model: The Variant model object.
+            is_created: Boolean indicating whether the variant is being created or modified.
+        """
+        variants_cache.invalidate(
+            sample_id for sample_id, in self.session.query(Var2Sample.sample_ID).filter(
+                Var2Sample.variant_key == model.key)
+        )
+
+
 ###############################################################################
 
 
@@ -338,7 +495,7 @@ admin.add_view(
     )
 )
 admin.add_view(
-    CustomView(
+    VariantView(
         Variant,
         db.session,
         category="Variant",
@@ -368,7 +525,7 @@ admin.add_view(
     )
 )
 admin.add_view(
-    CustomView(
+    Var2SampleView(
         Var2Sample,
         db.session,
         category="Variant",
@@ -0,0 +1,150 @@
+# (c) 2023, Charles VAN GOETHEM <c-vangoethem (at) chu-montpellier (dot) fr>
+#
+# This file is part of SEAL
+#
+# SEAL db - Simple, Efficient And Lite database for NGS
+# Copyright (C) 2023  Charles VAN GOETHEM - MoBiDiC - CHU Montpellier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import threading
+from collections import OrderedDict
+
+from seal import app
+
+
+class PayloadCache:
+    """
+    In-memory LRU cache of gzipped JSON payloads, bounded by the total size
+    of the compressed payloads.
+
+    The keys are tuples starting with the ID of the sample the payload
+    belongs to, to invalidate all the payloads of a sample at once. Each
+    invalidation of a sample increments its generation, a payload built
+    before is not stored (see `set`).
+    """
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size (int): The maximum size of the cache, in bytes. The
+                            cache is disabled if 0.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.generations = dict()
+        self.generation_all = 0
+        self.lock = threading.Lock()
+
+    def _generation(self, sample_id):
+        """Get the generation of a sample, the lock being held."""
+        return (self.generation_all, self.generations.get(int(sample_id), 0))
+
+    def generation(self, sample_id):
+        """
+        Get the generation of the payloads of a sample, to get before
+        building a payload.
+
+        Args:
+            sample_id (int): The ID of the sample.
+
+        Returns:
+            tuple: The generation.
+        """
+        with self.lock:
+            return self._generation(sample_id)
+
+    def get(self, key):
+        """
+        Get a payload and mark it as recently used.
+
+        Args:
+            key (tuple): The key of the payload.
+
+        Returns:
+            bytes: The gzipped payload, None if not cached.
+        """
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is not None:
+                self.entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload, generation=None):
+        """
+        Compress and store a payload, evicting the least recently used ones
+        beyond the maximum size.
+
+        Args:
+            key (tuple): The key of the payload.
+            payload (bytes): The JSON payload.
+            generation (tuple): The generation of the sample when the payload
+                                was built (see `generation`), the payload is
+                                not stored if the sample was invalidated
+                                since. Default is None, always stored.
+
+        Returns:
+            bytes: The gzipped payload.
+        """
+        compressed = gzip.compress(payload, compresslevel=6)
+        self.store(key, compressed, generation)
+        return compressed
+
+    def store(self, key, compressed, generation=None):
+        """
+        Store a payload already gzipped, see `set`.
+
+        Args:
+            key (tuple): The key of the payload.
+            compressed (bytes): The gzipped JSON payload.
+            generation (tuple): The generation of the sample when the payload
+                                was built. Default is None, always stored.
+        """
+        if len(compressed) > self.max_size:
+            return
+        with self.lock:
+            if generation is not None and generation != self._generation(key[0]):
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = compressed
+            self.size += len(compressed)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, sample_ids=None):
+        """
+        Remove the payloads of samples.
+
+        Args:
+            sample_ids (iterable): The IDs of the samples. Default is None,
+                                   all the payloads are removed.
+        """
+        with self.lock:
+            if sample_ids is None:
+                self.entries.clear()
+                self.size = 0
+                self.generation_all += 1
+                return
+            sample_ids = {int(id) for id in sample_ids}
+            for id in sample_ids:
+                self.generations[id] = self.generations.get(id, 0) + 1
+            for key in [k for k in self.entries if k[0] in sample_ids]:
+                self.size -= len(self.entries.pop(key))
+
+
+# Payloads of `json_variants`, by (sample, bed, version, preferences)
+variants_cache = PayloadCache(app.config.get("VARIANTS_CACHE_SIZE", 256) * 1024 * 1024)
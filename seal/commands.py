@@ -0,0 +1,403 @@
+# (c) 2023, Charles VAN GOETHEM <c-vangoethem (at) chu-montpellier (dot) fr>
+#
+# This file is part of SEAL
+#
+# SEAL db - Simple, Efficient And Lite database for NGS
+# Copyright (C) 2023  Charles VAN GOETHEM - MoBiDiC - CHU Montpellier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from contextlib import contextmanager
+
+import click
+from flask_login import login_user
+from sqlalchemy import event, exists
+
+from seal import app, db
+from seal.models import Annotation, Occurrence, Sample, User, Variant, Var2Sample
+from seal.filters import annotations_clause
+from seal.routes import json_history, json_variant, json_variants
+from seal.schedulers import select_main_annotation
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL queries executed in the block.
+
+    Yields:
+        list: A list, filled with the statements executed and their
+              parameters.
+    """
+    statements = list()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def request_variants(user, sample_id, form):
+    """
+    Call `json_variants` for a sample and count its queries.
+
+    Args:
+        user (User): The user requesting the variants.
+        sample_id (int): The id of the sample.
+        form (dict): The form of the request.
+
+    Returns:
+        tuple: The number of queries, the number of variants returned and the
+               duration in seconds.
+    """
+    db.session.expire_all()
+    with app.test_request_context(method="POST", data=form):
+        login_user(user)
+        with count_queries() as statements:
+            start = time.perf_counter()
+            response = json_variants(sample_id)
+            duration = time.perf_counter() - start
+    return len(statements), len(response.get_json()["data"]), duration
+
+
+def request_statements(user, view, method="GET", data=None, **kwargs):
+    """
+    Call a view as a user and collect its queries.
+
+    Args:
+        user (User): The user requesting the view.
+        view (function): The view.
+        method (str): The method of the request. Default is "GET".
+        data (dict): The form of the request. Default is None.
+        **kwargs: The arguments of the view.
+
+    Returns:
+        list: The statements executed and their parameters.
+    """
+    db.session.expire_all()
+    with app.test_request_context(method=method, data=data):
+        login_user(user)
+        with count_queries() as statements:
+            view(**kwargs)
+    return statements
+
+
+# Tables the main endpoints must read through an index
+INDEXED_TABLES = {
+    "var2sample", "variant", "annotation", "history", "omim", "occurrence",
+    "occurrence_team", "comment_variant", "comment_sample", "region2bed"
+}
+
+
+# Partitioned tables, the plans name their partitions (`<table>_p<remainder>`)
+PARTITIONED_TABLES = {"var2sample"}
+
+
+def parent_table(relation):
+    """
+    Get the table a relation of a query plan belongs to.
+
+    Args:
+        relation (str): The name of the relation, a table or a partition.
+
+    Returns:
+        str: The name of the partitioned table for a partition, else the
+             name of the relation.
+    """
+    for table in PARTITIONED_TABLES:
+        if relation.startswith(f"{table}_"):
+            return table
+    return relation
+
+
+def seq_scans(plan):
+    """
+    Find the tables read by a sequential scan in a query plan, the
+    partitions being reported as their partitioned table.
+
+    Args:
+        plan (dict): A node of the plan, from `EXPLAIN (FORMAT JSON)`.
+
+    Yields:
+        str: The name of the tables.
+    """
+    if plan.get("Node Type") == "Seq Scan":
+        yield parent_table(plan["Relation Name"])
+    for child in plan.get("Plans", list()):
+        yield from seq_scans(child)
+
+
+@app.cli.command("bench-variants")
+@click.argument("sample_id", type=int)
+@click.option("--length", default=10, help="Size of the small page.")
+@click.option("--username", default="admin", help="User requesting the variants.")
+def bench_variants(sample_id, length, username):
+    """
+    Check that the number of queries of json_variants does not depend on the
+    number of variants, for a page of LENGTH variants and for all the variants
+    of the sample SAMPLE_ID.
+    """
+    if Sample.query.get(sample_id) is None:
+        raise click.ClickException(f"Sample '{sample_id}' not found")
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found")
+
+    results = dict()
+    for name, size in (("page", length), ("all", -1)):
+        form = {"draw": 1, "start": 0, "length": size}
+        results[name] = request_variants(user, sample_id, form)
+        queries, variants, duration = results[name]
+        click.echo(f"{name}: {variants} variants, {queries} queries, {duration:.3f}s")
+
+    if results["page"][0] != results["all"][0]:
+        raise click.ClickException(
+            f"Number of queries grows with the number of variants "
+            f"({results['page'][0]} for {results['page'][1]} variants, "
+            f"{results['all'][0]} for {results['all'][1]} variants)"
+        )
+    click.echo("OK")
+
+
+@app.cli.command("recount-occurrences")
+def recount_occurrences():
+    """
+    Rebuild the occurrences of all the variants from the samples, to fill them
+    on an existing database or to repair them.
+    """
+    Occurrence.recount()
+    db.session.commit()
+    click.echo(f"{Occurrence.query.count()} variants counted")
+
+
+@app.cli.command("set-main-annotations")
+@click.option("--batch", default=1000, help="Number of variants updated per transaction.")
+def set_main_annotations(batch):
+    """
+    Store the main annotation of the versions of the variants imported before
+    it was selected at import.
+    """
+    updated = 0
+    last_id = ""
+    while True:
+        variants = Variant.query.filter(Variant.id > last_id).order_by(Variant.id).limit(batch).all()
+        if not variants:
+            break
+        for variant in variants:
+            if any("main" not in version for version in variant.annotations):
+                variant.annotations = [
+                    dict(stored, main=select_main_annotation(version["ANN"]))
+                    for stored, version in zip(variant.annotations, variant.annotationVersions())
+                ]
+                updated += 1
+        last_id = variants[-1].id
+        db.session.commit()
+    click.echo(f"{updated} variants updated")
+
+
+@app.cli.command("fill-annotations")
+@click.option("--batch", default=1000, help="Number of variants filled per transaction.")
+def fill_annotations(batch):
+    """
+    Fill the typed annotations of the variants imported before they were
+    stored in the annotation table.
+    """
+    filled = 0
+    last_id = ""
+    while True:
+        variants = Variant.query.filter(
+            Variant.id > last_id,
+            Variant.annotations.isnot(None),
+            ~exists().where(Annotation.variant_key == Variant.key)
+        ).order_by(Variant.id).limit(batch).all()
+        if not variants:
+            break
+        rows = list()
+        for variant in variants:
+            annotations = [
+                version if "main" in version else dict(version, main=select_main_annotation(version["ANN"]))
+                for version in variant.annotationVersions()
+            ]
+            rows.extend(Annotation.rows(variant.key, annotations))
+        Annotation.insert(rows)
+        filled += len(variants)
+        last_id = variants[-1].id
+        db.session.commit()
+    click.echo(f"{filled} variants filled")
+
+
+@app.cli.command("compact-annotations")
+@click.option("--batch", default=1000, help="Number of variants compacted per transaction.")
+def compact_annotations(batch):
+    """
+    Store the old annotation versions of the variants as deltas against the
+    next version.
+    """
+    compacted = 0
+    last_id = ""
+    while True:
+        variants = Variant.query.filter(
+            Variant.id > last_id,
+            annotations_clause("$[1]")
+        ).order_by(Variant.id).limit(batch).all()
+        if not variants:
+            break
+        for variant in variants:
+            if variant.compactAnnotations():
+                compacted += 1
+        last_id = variants[-1].id
+        db.session.commit()
+    click.echo(f"{compacted} variants compacted")
+
+
+@app.cli.command("check-plans")
+@click.argument("sample_id", type=int)
+@click.option("--username", default="admin", help="User requesting the endpoints.")
+def check_plans(sample_id, username):
+    """
+    Check with EXPLAIN that the queries of the main endpoints, for the sample
+    SAMPLE_ID and one of its variants, read the core tables through indexes.
+
+    Sequential scans are disabled while planning: a table still read by a
+    sequential scan has no index usable by the query.
+    """
+    if Sample.query.get(sample_id) is None:
+        raise click.ClickException(f"Sample '{sample_id}' not found")
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found")
+    variant_id = db.session.query(Variant.id).join(Var2Sample, Variant.samples).filter(
+        Var2Sample.sample_ID == sample_id).limit(1).scalar()
+    if variant_id is None:
+        raise click.ClickException(f"Sample '{sample_id}' has no variant")
+
+    endpoints = {
+        "json_variants": request_statements(
+            user, json_variants, "POST", {"draw": 1, "start": 0, "length": 10}, id=sample_id),
+        "json_variant": request_statements(user, json_variant, id=variant_id, sample=sample_id),
+        "json_history": request_statements(user, json_history, type="sample", id=sample_id)
+    }
+
+    failures = list()
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("SET enable_seqscan = off")
+        for name, statements in endpoints.items():
+            checked = 0
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith("SELECT"):
+                    continue
+                plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+                tables = INDEXED_TABLES.intersection(seq_scans(plan[0]["Plan"]))
+                if tables:
+                    failures.append(f"{name}: sequential scan on {', '.join(sorted(tables))}\n{statement}")
+                checked += 1
+            click.echo(f"{name}: {checked} queries checked")
+
+    if failures:
+        raise click.ClickException("\n\n".join(failures))
+    click.echo("OK")
+
+
+# Columns referencing `variant.id` replaced by a reference to `variant.key`:
+# table, old column, new column and primary key of the table
+VARIANT_REFERENCES = [
+    ("var2sample", "variant_ID", "variant_key", ["variant_key", "sample_ID"]),
+    ("occurrence", "variant_ID", "variant_key", ["variant_key"]),
+    ("occurrence_team", "variant_ID", "variant_key", ["variant_key", "team_ID"]),
+    ("annotation", "variant_ID", "variant_key", ["variant_key", "version", "rank"]),
+    ("comment_variant", "variantid", "variantkey", None)
+]
+
+
+@app.cli.command("migrate-variant-keys")
+def migrate_variant_keys():
+    """
+    Add the integer key of the variants to an existing database and replace
+    the references to the text ID of the variants by this key. Run it before
+    `flask db migrate`, which then only adds the indexes.
+    """
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            "ALTER TABLE variant ADD COLUMN IF NOT EXISTS key BIGINT GENERATED BY DEFAULT AS IDENTITY")
+        conn.exec_driver_sql(
+            "DO $$ BEGIN ALTER TABLE variant ADD CONSTRAINT variant_key_key UNIQUE (key); "
+            "EXCEPTION WHEN duplicate_table THEN NULL; END $$")
+
+        for table, old, new, primary_key in VARIANT_REFERENCES:
+            migrated = conn.exec_driver_sql(
+                "SELECT count(*) FROM information_schema.columns "
+                "WHERE table_name = %(table)s AND column_name = %(column)s",
+                {"table": table, "column": old}
+            ).scalar() == 0
+            if migrated:
+                click.echo(f"{table}: already migrated")
+                continue
+            conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN "{new}" BIGINT')
+            conn.exec_driver_sql(
+                f'UPDATE {table} SET "{new}" = variant.key FROM variant WHERE variant.id = {table}."{old}"')
+            conn.exec_driver_sql(f'ALTER TABLE {table} DROP COLUMN "{old}"')
+            conn.exec_driver_sql(f'ALTER TABLE {table} ALTER COLUMN "{new}" SET NOT NULL')
+            if primary_key:
+                columns = ", ".join(f'"{column}"' for column in primary_key)
+                conn.exec_driver_sql(f"ALTER TABLE {table} ADD PRIMARY KEY ({columns})")
+            conn.exec_driver_sql(
+                f'ALTER TABLE {table} ADD FOREIGN KEY ("{new}") REFERENCES variant (key)')
+            click.echo(f"{table}: {old} replaced by {new}")
+
+
+@app.cli.command("partition-var2sample")
+def partition_var2sample():
+    """
+    Convert the var2sample table of an existing database into a table
+    partitioned by hash of the sample, with VAR2SAMPLE_PARTITIONS partitions
+    (also converts a table partitioned by list of samples).
+    """
+    with db.engine.begin() as conn:
+        strategy = conn.exec_driver_sql(
+            "SELECT p.partstrat FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'var2sample'"
+        ).scalar()
+        if strategy == "h":
+            click.echo("var2sample: already partitioned")
+            return
+
+        # Free the names of the table and of its indexes
+        conn.exec_driver_sql("ALTER TABLE var2sample RENAME TO var2sample_old")
+        indexes = conn.exec_driver_sql(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'var2sample_old'"
+        ).scalars().all()
+        for index in indexes:
+            conn.exec_driver_sql(f'ALTER INDEX "{index}" RENAME TO "{index}_old"')
+
+        # Creates the partitions too
+        Var2Sample.__table__.create(conn)
+
+        # The columns added since the old table was created keep their default
+        old_columns = set(conn.exec_driver_sql(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'var2sample_old'"
+        ).scalars())
+        columns = ", ".join(
+            f'"{column.name}"' for column in Var2Sample.__table__.columns
+            if column.name in old_columns
+        )
+        conn.exec_driver_sql(
+            f"INSERT INTO var2sample ({columns}) SELECT {columns} FROM var2sample_old")
+        conn.exec_driver_sql("DROP TABLE var2sample_old")
+    click.echo(f"var2sample: {app.config.get('VAR2SAMPLE_PARTITIONS', 32)} partitions")
@@ -0,0 +1,708 @@
+# (c) 2023, Charles VAN GOETHEM <c-vangoethem (at) chu-montpellier (dot) fr>
+#
+# This file is part of SEAL
+#
+# SEAL db - Simple, Efficient And Lite database for NGS
+# Copyright (C) 2023  Charles VAN GOETHEM - MoBiDiC - CHU Montpellier
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import math
+
+from sqlalchemy import and_, or_, not_, case, func, cast, true, false, Boolean, Numeric
+from sqlalchemy.types import UserDefinedType
+
+from seal.models import Variant, Var2Sample
+
+
+###############################################################################
+# Rendered values of the columns
+
+
+CLASS_VARIANT = [
+    "",
+    "1 - Benign",
+    "2 - Likely Benign",
+    "3 - VUS",
+    "4 - Likely Pathogenic",
+    "5 - Pathogenic"
+]
+
+CLINVAR_BENIGN = "0 - Benign/Likely Benign"
+CLINVAR_CONFLICTING = "1 - Conflicting (without Pathogenic)"
+CLINVAR_NA = "2 - NA"
+CLINVAR_UNCERTAIN = "3 - Uncertain significance"
+CLINVAR_CONFLICTING_PATHOGENIC = "4 - Conflicting (with Pathogenic)"
+CLINVAR_PATHOGENIC = "5 - Pathogenic/Likely Pathogenic"
+
+
+def to_fixed(value, digits):
+    """
+    Format a number as `Number.toFixed` in javascript.
+
+    Args:
+        value: The value to format.
+        digits (int): The number of digits after the decimal point.
+
+    Returns:
+        str: The formatted value, empty if the value is not a number.
+    """
+    try:
+        return f"{float(value):.{digits}f}"
+    except (TypeError, ValueError):
+        return ""
+
+
+def to_string(value):
+    """
+    Convert a value as DataTables does for its search data.
+
+    Args:
+        value: The value to convert.
+
+    Returns:
+        str: The converted value.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, list):
+        return ",".join(to_string(v) for v in value)
+    return str(value)
+
+
+def clinvar_class(clinvar):
+    """
+    Classify the ClinVar significance of a variant as the `clinvar`
+    SearchBuilder condition does.
+
+    Args:
+        clinvar (dict): The ClinVar fields of the variant (CLNSIG,
+                        CLNSIGCONF).
+
+    Returns:
+        str: The class of the variant.
+    """
+    clnsig = clinvar.get("CLNSIG") or ""
+    clnsigconf = clinvar.get("CLNSIGCONF") or ""
+    if not clnsig:
+        return CLINVAR_NA
+    if re.search("conflicting", clnsig, re.I):
+        if re.search("pathogenic", clnsigconf, re.I) or re.search("establish", clnsig, re.I):
+            return CLINVAR_CONFLICTING_PATHOGENIC
+        return CLINVAR_CONFLICTING
+    if re.search("pathogenic|establish", clnsig, re.I):
+        return CLINVAR_PATHOGENIC
+    if re.search("uncertain", clnsig, re.I):
+        return CLINVAR_UNCERTAIN
+    if re.search("benign", clnsig, re.I):
+        return CLINVAR_BENIGN
+    return CLINVAR_NA
+
+
+def exon_intron(annotation):
+    """Exon or intron of an annotation, as the E|I column."""
+    if annotation.get("EXON") is None:
+        if annotation.get("INTRON") is None:
+            return "NA"
+        return annotation["INTRON"]
+    return annotation["EXON"]
+
+
+def phenotypes(row):
+    """OMIM phenotypes of a variant, as the Transmission column."""
+    inheritances = "".join(
+        f"{pheno['inheritances']} ({pheno['phenotype']}) | "
+        for pheno in row["phenotypes"]
+    )
+    return re.sub(r"^\s*\|*|\s*\|*\s*$", "", inheritances)
+
+
+def mes_var(annotation):
+    """MaxEntScan variation of an annotation, as the MaxEnt column."""
+    if annotation.get("MES_var") is None:
+        return ""
+    return to_string(abs(round(float(annotation["MES_var"]), 3)))
+
+
+def annotation_value(field, render=to_string):
+    """Extractor of a field of the main annotation of a variant."""
+    def value(row):
+        annotation = row["annotations"] or dict()
+        return render(annotation.get(field))
+    return value
+
+
+# Values searched by SearchBuilder for each column, by `origData`
+# (javascript renders `_`, `filter` or `sb` in `sample.html`)
+COLUMNS_VALUES = {
+    "annotations.SYMBOL": annotation_value("SYMBOL", lambda v: "<i>NA</i>" if v is None else to_string(v)),
+    "annotations.HGVSg": annotation_value("HGVSg"),
+    "annotations.HGVSp": annotation_value("HGVSp", lambda v: "NA" if v is None else to_string(v)),
+    "annotations.HGVSc": annotation_value("HGVSc", lambda v: "NA" if v is None else to_string(v)),
+    "annotations.gnomADg_AF": annotation_value("gnomADg_AF", lambda v: to_fixed(v, 6)),
+    "annotations.IMPACT": annotation_value("IMPACT"),
+    "annotations.Consequence": annotation_value("Consequence"),
+    "annotations.spliceAI": annotation_value("spliceAI", lambda v: to_fixed(v, 3)),
+    "annotations.missensesMean": annotation_value("missensesMean", lambda v: to_fixed(v, 4)),
+    "annotations.MES_var": lambda row: mes_var(row["annotations"] or dict()),
+    "annotations.NEAREST": annotation_value("NEAREST"),
+    "annotations.Feature": annotation_value("Feature"),
+    "annotations.Existing_variation": annotation_value("Existing_variation"),
+    "filter": lambda row: to_string(row["filter"]),
+    "inseal": lambda row: to_string(row["inseal"]["occurrences"]) if row["inseal"]["occurrences"] > 0 else "NA",
+    "clinvar": lambda row: clinvar_class(row["clinvar"]),
+    "phenotypes": phenotypes,
+    "reported": lambda row: "Reported" if row["reported"] else "Not Reported",
+    "class_variant": lambda row: CLASS_VARIANT[row["class_variant"] or 0],
+    "id": lambda row: row["id"],
+    "chr": lambda row: row["chr"],
+    "pos": lambda row: row["pos"],
+    "depth": lambda row: row["depth"],
+    "allelic_depth": lambda row: row["allelic_depth"],
+    "allelic_frequency": lambda row: row["allelic_frequency"]
+}
+
+
+def column_key(criterion):
+    """
+    Get the column targeted by a criterion.
+
+    `origData` is the `data` option of the column: a string, an object for the
+    columns rendered from the whole row, or null for the columns without data.
+    An empty object is dropped by the form encoding of the request.
+
+    Args:
+        criterion (dict): The criterion.
+
+    Returns:
+        str: The column key (see `COLUMNS_VALUES`), None for a column without
+             data.
+    """
+    orig_data = criterion.get("origData", dict())
+    if isinstance(orig_data, dict):
+        return orig_data.get("data", "allelic_frequency")
+    if not orig_data:
+        return None
+    if orig_data == "annotations":
+        if criterion.get("data") == "E|I":
+            return "annotations.EI"
+        return "annotations.HGVSc"
+    return orig_data
+
+
+def column_value(key):
+    """
+    Get the function extracting the searched value of a column from a
+    serialized variant.
+
+    Args:
+        key (str): The column key.
+
+    Returns:
+        function: The function, taking the variant row and returning a string.
+    """
+    if key is None:
+        return lambda row: ""
+    if key == "annotations.EI":
+        return lambda row: exon_intron(row["annotations"] or dict())
+    if key.startswith("family."):
+        member = key.split(".", 1)[1]
+        return lambda row: to_string(row["family"].get(member, dict()).get("allelic_frequency"))
+    if key in COLUMNS_VALUES:
+        return COLUMNS_VALUES[key]
+    if key.startswith("annotations."):
+        return annotation_value(key.split(".", 1)[1])
+    return lambda row: to_string(row.get(key))
+
+
+###############################################################################
+# Conditions
+
+
+def js_number(value):
+    """
+    Convert a string to a number as the unary `+` in javascript.
+
+    Args:
+        value (str): The value to convert.
+
+    Returns:
+        float: The number, nan if the value is not a number.
+    """
+    value = to_string(value).strip()
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def strip_number(value):
+    """Keep only the number of a formatted value (`num-fmt` columns)."""
+    value = to_string(value)
+    number = re.sub(r"[^0-9.]", "", value)
+    return "-" + number if value.startswith("-") else number
+
+
+def number_test(condition, values):
+    """
+    Build the test of a numeric SearchBuilder condition.
+
+    Args:
+        condition (str): The condition.
+        values (list): The numbers of the criterion.
+
+    Returns:
+        function: The test, taking the number of the cell.
+    """
+    values = values + [math.nan] * (2 - len(values))
+    if condition in ("between", "!between"):
+        low, high = values[:2] if values[0] < values[1] else values[1::-1]
+        between = lambda v: low <= v <= high
+        return between if condition == "between" else lambda v: not between(v)
+    value = values[0]
+    return {
+        "=": lambda v: v == value,
+        "!=": lambda v: v != value,
+        "<": lambda v: v < value,
+        "<=": lambda v: v <= value,
+        ">=": lambda v: v >= value,
+        ">": lambda v: v > value
+    }[condition]
+
+
+def string_test(condition, value):
+    """
+    Build the test of a string SearchBuilder condition.
+
+    Args:
+        condition (str): The condition.
+        value (str): The value of the criterion.
+
+    Returns:
+        function: The test, taking the string of the cell.
+    """
+    lower = value.lower()
+    return {
+        "=": lambda v: v == value,
+        "!=": lambda v: v != value,
+        "starts": lambda v: v.lower().startswith(lower),
+        "!starts": lambda v: not v.lower().startswith(lower),
+        "contains": lambda v: lower in v.lower(),
+        "!contains": lambda v: lower not in v.lower(),
+        "ends": lambda v: v.lower().endswith(lower),
+        "!ends": lambda v: not v.lower().endswith(lower)
+    }[condition]
+
+
+def criterion_predicate(criterion):
+    """
+    Build the python predicate of a criterion.
+
+    Args:
+        criterion (dict): The criterion (`condition`, `origData`, `data`,
+                          `type`, `value`).
+
+    Returns:
+        function: The predicate, taking a serialized variant.
+    """
+    condition = criterion["condition"]
+    kind = criterion.get("type") or "string"
+    values = [to_string(v) for v in criterion.get("value", list())]
+    get_value = column_value(column_key(criterion))
+
+    if "html" in kind:
+        get_cell = lambda row: re.sub(r"<([^>]+)>", "", get_value(row))
+    else:
+        get_cell = get_value
+
+    if condition == "null":
+        return lambda row: len(get_cell(row)) == 0
+    if condition == "!null":
+        return lambda row: len(get_cell(row)) > 0
+
+    if kind == "clinvar":
+        value = values[0] if values else ""
+        if condition == "!=":
+            return lambda row: get_cell(row) != value
+        return lambda row: get_cell(row) == value
+
+    if "num" in kind:
+        if "fmt" in kind:
+            test = number_test(condition, [js_number(strip_number(v)) for v in values])
+            return lambda row: test(js_number(strip_number(get_cell(row))))
+        test = number_test(condition, [js_number(v) for v in values])
+        return lambda row: test(js_number(get_cell(row)))
+
+    test = string_test(condition, values[0] if values else "")
+    return lambda row: test(get_cell(row))
+
+
+def is_group(criterion):
+    """Check if a criterion is a group of criteria."""
+    return "criteria" in criterion
+
+
+def is_filled(criterion):
+    """
+    Check if a criterion is complete, as SearchBuilder ignores the others.
+
+    Args:
+        criterion (dict): The criterion or group of criteria.
+
+    Returns:
+        bool: True if the criterion is used to filter.
+    """
+    if is_group(criterion):
+        return any(is_filled(c) for c in criterion["criteria"])
+    condition = criterion.get("condition")
+    if not condition:
+        return False
+    if condition in ("null", "!null"):
+        return True
+    return len(criterion.get("value", list())) > 0
+
+
+def criteria_predicate(criteria):
+    """
+    Build the python predicate of a group of criteria.
+
+    Args:
+        criteria (dict): The group of criteria (`criteria`, `logic`).
+
+    Returns:
+        function: The predicate, taking a serialized variant.
+    """
+    predicates = [
+        criteria_predicate(c) if is_group(c) else criterion_predicate(c)
+        for c in criteria["criteria"] if is_filled(c)
+    ]
+    if criteria.get("logic", "AND") == "OR":
+        return lambda row: any(p(row) for p in predicates)
+    return lambda row: all(p(row) for p in predicates)
+
+
+###############################################################################
+# SQL
+
+
+def clinvar_class_sql():
+    """
+    SQL expression of `clinvar_class`.
+
+    Returns:
+        sqlalchemy.sql.expression.Case: The class of the variant.
+    """
+    clnsig = Variant.clinvar_CLNSIG
+    return case(
+        (func.coalesce(clnsig, "") == "", CLINVAR_NA),
+        (clnsig.op("~*")("conflicting"), case(
+            (or_(
+                func.coalesce(Variant.clinvar_CLNSIGCONF, "").op("~*")("pathogenic"),
+                clnsig.op("~*")("establish")
+            ), CLINVAR_CONFLICTING_PATHOGENIC),
+            else_=CLINVAR_CONFLICTING
+        )),
+        (clnsig.op("~*")("pathogenic|establish"), CLINVAR_PATHOGENIC),
+        (clnsig.op("~*")("uncertain"), CLINVAR_UNCERTAIN),
+        (clnsig.op("~*")("benign"), CLINVAR_BENIGN),
+        else_=CLINVAR_NA
+    )
+
+
+def text_columns():
+    """SQL expressions of the text columns, by column key."""
+    return {
+        "id": Variant.id,
+        "chr": Variant.chr,
+        "filter": func.coalesce(func.array_to_string(Var2Sample.filter, ","), ""),
+        "clinvar": clinvar_class_sql(),
+        "reported": case((Var2Sample.reported, "Reported"), else_="Not Reported"),
+        "class_variant": case(
+            *[(Variant.class_variant == idx, label) for idx, label in enumerate(CLASS_VARIANT) if idx],
+            else_=""
+        )
+    }
+
+
+def number_columns():
+    """SQL expressions of the numeric columns, by column key."""
+    return {
+        "pos": Variant.pos,
+        "depth": Var2Sample.depth,
+        "allelic_depth": Var2Sample.allelic_depth,
+        "allelic_frequency": func.round(
+            cast(Var2Sample.allelic_depth, Numeric) / func.nullif(Var2Sample.depth, 0), 4
+        )
+    }
+
+
+def annotation_columns(annotation, kind):
+    """
+    SQL expressions of the columns of the main annotation, by column key.
+
+    Args:
+        annotation: The `Annotation` entity joined as the main annotation of
+                    the variants.
+        kind (str): The SearchBuilder type of the column.
+
+    Returns:
+        dict: The numeric columns for a numeric type, else the text columns.
+    """
+    if "num" in kind:
+        return {
+            "annotations.gnomADg_AF": func.round(cast(annotation.gnomadg_af, Numeric), 6),
+            "annotations.spliceAI": func.round(cast(annotation.spliceai, Numeric), 3),
+            "annotations.missensesMean": func.round(cast(annotation.missenses_mean, Numeric), 4),
+            "annotations.MES_var": func.abs(func.round(cast(annotation.mes_var, Numeric), 3))
+        }
+    return {
+        "annotations.SYMBOL": func.coalesce(annotation.symbol, "NA" if "html" in kind else "<i>NA</i>"),
+        "annotations.HGVSg": annotation.hgvsg,
+        "annotations.HGVSp": func.coalesce(annotation.hgvsp, "NA"),
+        "annotations.HGVSc": func.coalesce(annotation.hgvsc, "NA"),
+        "annotations.EI": func.coalesce(annotation.exon_intron, "NA"),
+        "annotations.IMPACT": annotation.impact,
+        "annotations.Consequence": func.array_to_string(annotation.consequence, ","),
+        "annotations.Feature": annotation.feature
+    }
+
+
+def criterion_clause(criterion, annotation=None):
+    """
+    Compile a criterion into SQL.
+
+    Args:
+        criterion (dict): The criterion.
+        annotation: The `Annotation` entity joined as the main annotation of
+                    the variants, None if it is not joined.
+
+    Returns:
+        sqlalchemy.sql.elements.ClauseElement: The clause, None if the
+        criterion targets a column only available on serialized variants.
+    """
+    condition = criterion["condition"]
+    kind = criterion.get("type") or "string"
+    values = [to_string(v) for v in criterion.get("value", list())]
+    key = column_key(criterion)
+
+    if "num" in kind:
+        columns = number_columns()
+        if annotation is not None:
+            columns.update(annotation_columns(annotation, kind))
+        column = columns.get(key)
+        if column is None:
+            return None
+        if condition == "null":
+            return column.is_(None)
+        if condition == "!null":
+            return column.isnot(None)
+        # An empty cell is the number 0 for SearchBuilder
+        column = func.coalesce(column, 0)
+        if "fmt" in kind:
+            values = [strip_number(v) for v in values]
+        numbers = [js_number(v) for v in values] + [math.nan] * (2 - len(values))
+        needed = 2 if condition in ("between", "!between") else 1
+        if any(math.isnan(n) for n in numbers[:needed]):
+            return true() if condition in ("!=", "!between") else false()
+        if condition in ("between", "!between"):
+            low, high = sorted(numbers[:2])
+            clause = column.between(low, high)
+            return clause if condition == "between" else not_(clause)
+        value = numbers[0]
+        return {
+            "=": column == value,
+            "!=": column != value,
+            "<": column < value,
+            "<=": column <= value,
+            ">=": column >= value,
+            ">": column > value
+        }[condition]
+
+    columns = text_columns()
+    if annotation is not None:
+        columns.update(annotation_columns(annotation, kind))
+    column = columns.get(key)
+    if column is None:
+        return None
+    column = func.coalesce(column, "")
+    if condition == "null":
+        return column == ""
+    if condition == "!null":
+        return column != ""
+    value = values[0] if values else ""
+    if kind == "clinvar" or condition in ("=", "!="):
+        return column == value if condition == "=" else column != value
+    lower = func.lower(column)
+    clause = {
+        "starts": lower.startswith,
+        "contains": lower.contains,
+        "ends": lower.endswith
+    }[condition.lstrip("!")](value.lower(), autoescape=True)
+    return not_(clause) if condition.startswith("!") else clause
+
+
+def criteria_clause(criteria, annotation=None):
+    """
+    Compile a group of criteria into SQL.
+
+    Args:
+        criteria (dict): The group of criteria (`criteria`, `logic`).
+        annotation: The `Annotation` entity joined as the main annotation of
+                    the variants, None if it is not joined.
+
+    Returns:
+        sqlalchemy.sql.elements.ClauseElement: The clause, None if a criterion
+        cannot be compiled.
+    """
+    clauses = list()
+    for criterion in criteria["criteria"]:
+        if not is_filled(criterion):
+            continue
+        if is_group(criterion):
+            clause = criteria_clause(criterion, annotation)
+        else:
+            clause = criterion_clause(criterion, annotation)
+        if clause is None:
+            return None
+        clauses.append(clause)
+    if not clauses:
+        return true()
+    if criteria.get("logic", "AND") == "OR":
+        return or_(*clauses)
+    return and_(*clauses)
+
+
+def compile_criteria(criteria, annotation=None):
+    """
+    Compile SearchBuilder criteria into a SQL clause and, for the criteria
+    which cannot be evaluated in database, a python predicate.
+
+    With the logic AND, each criterion compiled into SQL is applied in
+    database and only the others are left to the predicate.
+
+    Args:
+        criteria (dict): The criteria (`criteria`, `logic`), as saved in
+                         `Filter.filter`.
+        annotation: The `Annotation` entity joined as the main annotation of
+                    the variants, to compile the criteria on its columns.
+                    Default is None, they are left to the predicate.
+
+    Returns:
+        tuple: The SQL clause (None if nothing is filtered in database) and
+               the predicate on serialized variants (None if not needed).
+    """
+    if not criteria or not is_filled(criteria):
+        return None, None
+
+    clause = criteria_clause(criteria, annotation)
+    if clause is not None:
+        return clause, None
+    if criteria.get("logic", "AND") == "OR":
+        return None, criteria_predicate(criteria)
+
+    clauses = list()
+    remaining = list()
+    for criterion in criteria["criteria"]:
+        if not is_filled(criterion):
+            continue
+        if is_group(criterion):
+            clause = criteria_clause(criterion, annotation)
+        else:
+            clause = criterion_clause(criterion, annotation)
+        if clause is None:
+            remaining.append(criterion)
+        else:
+            clauses.append(clause)
+
+    clause = and_(*clauses) if clauses else None
+    predicate = criteria_predicate({"criteria": remaining, "logic": "AND"})
+    return clause, predicate
+
+
+class JSONPath(UserDefinedType):
+    """The `jsonpath` type of PostgreSQL."""
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "JSONPATH"
+
+
+def annotations_clause(path):
+    """
+    Compile a SQL/JSON path predicate on the annotations of the variants,
+    evaluated with the operator `@?`. The clause is not indexed: it is meant
+    to refine variants already selected by the sample (the typed `Annotation`
+    table serves the indexed filtering). Only the last version holds its full
+    `ANN`, the older ones may be stored as deltas (see
+    `Variant.compactAnnotations`).
+
+    Args:
+        path (str): The JSON path, e.g.
+                    `$[*].ANN[*] ? (@.SYMBOL == "BRCA1")`.
+
+    Returns:
+        sqlalchemy.sql.elements.BinaryExpression: The clause.
+    """
+    return Variant.annotations.op("@?", return_type=Boolean)(cast(path, JSONPath()))
+
+
+###############################################################################
+# Request
+
+
+def parse_nested_form(form, name):
+    """
+    Rebuild an object sent with the form encoding of jQuery
+    (`name[criteria][0][value][]=...`).
+
+    Args:
+        form (werkzeug.datastructures.MultiDict): The form of the request.
+        name (str): The name of the object.
+
+    Returns:
+        dict: The object, None if not sent.
+    """
+    root = dict()
+    found = False
+    for key, values in form.lists():
+        if not key.startswith(f"{name}["):
+            continue
+        found = True
+        path = re.findall(r"\[([^\]]*)\]", key[len(name):])
+        if path[-1] == "":
+            path, values = path[:-1], list(values)
+        else:
+            values = values[-1]
+        node = root
+        for part in path[:-1]:
+            node = node.setdefault(part, dict())
+        node[path[-1]] = values
+    return to_lists(root) if found else None
+
+
+def to_lists(node):
+    """Convert the objects with only numeric keys into lists."""
+    if not isinstance(node, dict):
+        return node
+    node = {k: to_lists(v) for k, v in node.items()}
+    if node and all(k.isdigit() for k in node):
+        return [node[k] for k in sorted(node, key=int)]
+    return node
@@ -18,14 +18,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bisect
 from datetime import datetime
+from itertools import chain
 
-from seal import db, login_manager, bcrypt
+from seal import app, db, login_manager, bcrypt
 
 from flask_login import UserMixin
 
-from sqlalchemy import select, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import event, select, update, func, literal, literal_column, or_
+from sqlalchemy.orm import relationship, query_expression, Session
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.dialects import postgresql
@@ -147,6 +149,22 @@ class Clinvar(db.Model):
         return str(self.version)
 
 
+class Clinvar_variant(db.Model):
+    version = db.Column(db.Integer, db.ForeignKey('clinvar.version'), primary_key=True)
+    variant_ID = db.Column(db.Text, primary_key=True)
+
+    VARID = db.Column(db.Integer, unique=False, nullable=True)
+    CLNSIG = db.Column(db.String(500), unique=False, nullable=True)
+    CLNSIGCONF = db.Column(db.String(500), unique=False, nullable=True)
+    CLNREVSTAT = db.Column(db.String(500), unique=False, nullable=True)
+
+    def __repr__(self):
+        return f"Clinvar_variant('{self.version}','{self.variant_ID}')"
+
+    def __str__(self):
+        return f"{self.variant_ID} ({self.version})"
+
+
 ################################################################################
 
 
@@ -154,6 +172,10 @@ class Clinvar(db.Model):
 # Analysis
 
 class History(db.Model):
+    __table_args__ = (
+        db.Index("ix_history_sample_date", "sample_ID", "date"),
+    )
+
     user_ID = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, default=1)
     user = relationship("User", back_populates="historics")
     sample_ID = db.Column(db.Integer, db.ForeignKey('sample.id'), primary_key=True)
@@ -170,6 +192,8 @@ class Sample(db.Model):
     status = db.Column(db.Integer, unique=False, nullable=False, default=0)
     affected = db.Column(db.Boolean(), default=False)
     index = db.Column(db.Boolean(), default=False)
+    # Incremented on each change of its variants, see `Var2Sample.touch`
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     filter_id = db.Column(db.Integer, db.ForeignKey('filter.id'), nullable=True)
     filter = relationship("Filter", back_populates="samples")
@@ -236,13 +260,22 @@ class Run(db.Model):
 
 
 class Variant(db.Model):
+    __table_args__ = (
+        db.Index("ix_variant_chr_pos", "chr", "pos"),
+    )
+
     id = db.Column(db.Text, primary_key=True)
+    # Compact key of the variant, referenced by the other tables
+    key = db.Column(db.BigInteger, db.Identity(), unique=True, nullable=False)
     chr = db.Column(db.String(10), unique=False, nullable=False)
     pos = db.Column(db.Integer, unique=False, nullable=False)
     ref = db.Column(db.String(500), unique=False, nullable=False)
     alt = db.Column(db.String(500), unique=False, nullable=False)
     class_variant = db.Column(db.Integer, unique=False, default=None)
-    annotations = db.Column(db.JSON, nullable=True)
+    annotations = db.Column(postgresql.JSONB, nullable=True)
+    # The last annotation version with some fields only, loaded instead of
+    # `annotations` when queried (see `projectedVersion`)
+    projected_version = query_expression()
     comments = relationship("Comment_variant")
 
     clinvar_VARID = db.Column(db.Integer, unique=False, nullable=True)
@@ -256,13 +289,292 @@ class Variant(db.Model):
     def __str__(self):
         return self.id
 
+    def annotationVersion(self, version=-1):
+        """
+        Get an annotation version of the variant, rebuilt from the newer
+        versions if it is stored as a delta (see `compactAnnotations`).
+
+        Args:
+            version (int): The index of the version. Default is -1, the last
+                           one, always stored in full.
+
+        Returns:
+            dict: The version (`date`, `main` and `ANN`).
+        """
+        versions = self.annotations
+        if version < 0:
+            version += len(versions)
+        if not 0 <= version < len(versions):
+            raise IndexError(f"No annotation version {version} for {self.id}")
+        current = versions[-1]
+        for idx in range(len(versions) - 2, version - 1, -1):
+            current = Variant.expandVersion(versions[idx], current)
+        return current
+
+    @staticmethod
+    def projectedVersion(fields):
+        """
+        SQL expression of the last annotation version of the variants with
+        only some fields of their annotations, the other fields are not
+        sent by the database. The missing fields are null.
+
+        Args:
+            fields (iterable): The fields of the annotations.
+
+        Returns:
+            sqlalchemy.sql.elements.ColumnElement: The version (`date`,
+                                                   `main` and `ANN`).
+        """
+        last = Variant.annotations[-1]
+        annotation = func.jsonb_array_elements(last["ANN"]).table_valued(
+            db.column("value", postgresql.JSONB), with_ordinality="idx"
+        ).render_derived(name="annotation")
+
+        # jsonb_build_object takes 100 arguments at most
+        fields = list(fields)
+        projected = None
+        for start in range(0, len(fields), 50):
+            part = func.jsonb_build_object(*chain.from_iterable(
+                (literal(field), annotation.c.value[field])
+                for field in fields[start:start + 50]
+            ))
+            projected = part if projected is None else projected.op("||")(part)
+        if projected is None:
+            projected = func.jsonb_build_object()
+
+        annotations = select(func.coalesce(
+            func.jsonb_agg(postgresql.aggregate_order_by(projected, annotation.c.idx)),
+            db.cast("[]", postgresql.JSONB)
+        )).correlate(Variant).scalar_subquery()
+        return func.jsonb_build_object(
+            "date", last["date"],
+            "main", last["main"],
+            "ANN", annotations
+        )
+
+    def annotationVersions(self):
+        """
+        Get all the annotation versions of the variant, rebuilt.
+
+        Returns:
+            list: The versions, from the oldest to the last.
+        """
+        versions = list(self.annotations)
+        for idx in range(len(versions) - 2, -1, -1):
+            versions[idx] = Variant.expandVersion(versions[idx], versions[idx + 1])
+        return versions
+
+    def compactAnnotations(self):
+        """
+        Store each annotation version but the last one as a delta against the
+        next version: per transcript, only the fields that changed.
+
+        Returns:
+            bool: True if the annotations were changed.
+        """
+        versions = self.annotationVersions()
+        compacted = [
+            Variant.compactVersion(version, newer)
+            for version, newer in zip(versions, versions[1:])
+        ] + versions[-1:]
+        if compacted == self.annotations:
+            return False
+        self.annotations = compacted
+        return True
+
+    @staticmethod
+    def compactVersion(version, newer):
+        """
+        Compute the delta of an annotation version against the next one.
+
+        Each annotation of the version becomes `{"base": rank, "set": {...},
+        "unset": [...]}`, `rank` being the annotation of the same transcript
+        in the newer version (None if there is none, `set` is then the whole
+        annotation).
+
+        Args:
+            version (dict): The version to compact.
+            newer (dict): The next version, in full.
+
+        Returns:
+            dict: The compacted version, with `delta` instead of `ANN`.
+        """
+        ranks = dict()
+        for rank, annot in enumerate(newer["ANN"]):
+            ranks.setdefault(annot.get("Feature"), list()).append(rank)
+
+        delta = list()
+        for annot in version["ANN"]:
+            same = ranks.get(annot.get("Feature"))
+            if not same:
+                delta.append({"base": None, "set": annot, "unset": list()})
+                continue
+            rank = same.pop(0)
+            base = newer["ANN"][rank]
+            delta.append({
+                "base": rank,
+                "set": {k: v for k, v in annot.items() if k not in base or base[k] != v},
+                "unset": sorted(k for k in base if k not in annot)
+            })
+        compacted = {k: v for k, v in version.items() if k != "ANN"}
+        compacted["delta"] = delta
+        return compacted
+
+    @staticmethod
+    def expandVersion(version, newer):
+        """
+        Rebuild an annotation version stored as a delta.
+
+        Args:
+            version (dict): The version as stored, compacted or not.
+            newer (dict): The next version, in full.
+
+        Returns:
+            dict: The version, in full.
+        """
+        if "delta" not in version:
+            return version
+        annotations = list()
+        for delta in version["delta"]:
+            annot = dict(newer["ANN"][delta["base"]]) if delta["base"] is not None else dict()
+            for key in delta["unset"]:
+                annot.pop(key, None)
+            annot.update(delta["set"])
+            annotations.append(annot)
+        expanded = {k: v for k, v in version.items() if k != "delta"}
+        expanded["ANN"] = annotations
+        return expanded
+
+
+class Annotation(db.Model):
+    """
+    Typed copy of the most used fields of the VEP annotations of a variant,
+    one row per transcript (`rank` in the `ANN` list) and version, to filter
+    them in SQL. `Variant.annotations` keeps all the fields.
+    """
+    __table_args__ = (
+        db.Index("ix_annotation_feature", "feature"),
+        db.Index("ix_annotation_symbol", "symbol"),
+        db.Index("ix_annotation_gnomadg_af", "gnomadg_af"),
+        db.Index("ix_annotation_spliceai", "spliceai"),
+        db.Index("ix_annotation_missenses_mean", "missenses_mean"),
+        db.Index("ix_annotation_main", "variant_key", "version", postgresql_where=db.text("main")),
+    )
+
+    variant_key = db.Column(db.BigInteger, db.ForeignKey('variant.key'), primary_key=True)
+    version = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    main = db.Column(db.Boolean, nullable=False, default=False)
+
+    feature = db.Column(db.String(30), nullable=True)
+    symbol = db.Column(db.String(50), nullable=True)
+    source = db.Column(db.String(30), nullable=True)
+    biotype = db.Column(db.String(50), nullable=True)
+    canonical = db.Column(db.Boolean, nullable=False, default=False)
+    impact = db.Column(db.String(20), nullable=True)
+    consequence = db.Column(db.ARRAY(db.String(50)), nullable=True)
+    consequence_score = db.Column(db.Integer, nullable=False, default=0)
+    hgvsg = db.Column(db.Text, nullable=True)
+    hgvsc = db.Column(db.Text, nullable=True)
+    hgvsp = db.Column(db.Text, nullable=True)
+    exon_intron = db.Column(db.String(20), nullable=True)
+
+    gnomadg_af = db.Column(db.Float, nullable=True)
+    gnomadg_af_afr = db.Column(db.Float, nullable=True)
+    gnomadg_af_amr = db.Column(db.Float, nullable=True)
+    gnomadg_af_asj = db.Column(db.Float, nullable=True)
+    gnomadg_af_eas = db.Column(db.Float, nullable=True)
+    gnomadg_af_fin = db.Column(db.Float, nullable=True)
+    gnomadg_af_nfe = db.Column(db.Float, nullable=True)
+    gnomadg_af_oth = db.Column(db.Float, nullable=True)
+    missenses_mean = db.Column(db.Float, nullable=True)
+    spliceai = db.Column(db.Float, nullable=True)
+    mes_var = db.Column(db.Float, nullable=True)
+
+    variant = db.relationship(Variant)
+
+    # Columns filled from the fields of a VEP annotation
+    FIELDS = {
+        "feature": "Feature",
+        "symbol": "SYMBOL",
+        "source": "SOURCE",
+        "biotype": "BIOTYPE",
+        "impact": "IMPACT",
+        "consequence": "Consequence",
+        "consequence_score": "consequenceScore",
+        "hgvsg": "HGVSg",
+        "hgvsc": "HGVSc",
+        "hgvsp": "HGVSp",
+        "exon_intron": "EI",
+        "gnomadg_af": "gnomADg_AF",
+        "gnomadg_af_afr": "gnomADg_AF_AFR",
+        "gnomadg_af_amr": "gnomADg_AF_AMR",
+        "gnomadg_af_asj": "gnomADg_AF_ASJ",
+        "gnomadg_af_eas": "gnomADg_AF_EAS",
+        "gnomadg_af_fin": "gnomADg_AF_FIN",
+        "gnomadg_af_nfe": "gnomADg_AF_NFE",
+        "gnomadg_af_oth": "gnomADg_AF_OTH",
+        "missenses_mean": "missensesMean",
+        "spliceai": "spliceAI",
+        "mes_var": "MES_var"
+    }
+
+    def __repr__(self):
+        return f"Annotation('{self.variant_key}','{self.version}','{self.feature}')"
+
+    def __str__(self):
+        return f"{self.variant_key} - {self.feature}"
+
+    @staticmethod
+    def rows(variant_key, annotations):
+        """
+        Build the rows of the annotations of a variant.
+
+        Args:
+            variant_key (int): The key of the variant.
+            annotations (list): The annotation versions of the variant, as
+                                stored in `Variant.annotations`.
+
+        Returns:
+            list: The rows (dict), to insert in the `annotation` table.
+        """
+        rows = list()
+        for version, annotation in enumerate(annotations):
+            main = annotation.get("main")
+            for rank, annot in enumerate(annotation["ANN"]):
+                row = {column: annot.get(field) for column, field in Annotation.FIELDS.items()}
+                row.update({
+                    "variant_key": variant_key,
+                    "version": version,
+                    "rank": rank,
+                    "main": rank == main,
+                    "canonical": bool(annot.get("canonical")),
+                    "consequence_score": row["consequence_score"] or 0
+                })
+                rows.append(row)
+        return rows
+
+    @staticmethod
+    def insert(rows):
+        """
+        Insert annotation rows, the ones already stored are left unchanged.
+
+        Args:
+            rows (list): The rows, see `rows`.
+        """
+        if rows:
+            stmt = postgresql.insert(Annotation.__table__).on_conflict_do_nothing(
+                index_elements=["variant_key", "version", "rank"]
+            )
+            db.session.execute(stmt, rows)
+
 
 class Comment_variant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     comment = db.Column(db.Text, nullable=False)
     date = db.Column(db.TIMESTAMP(timezone=False), nullable=False, default=datetime.now())
 
-    variantid = db.Column(db.Text, db.ForeignKey('variant.id'), nullable=False)
+    variantkey = db.Column(db.BigInteger, db.ForeignKey('variant.key'), nullable=False, index=True)
     variant = relationship("Variant", back_populates="comments")
 
     userid = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -280,7 +592,7 @@ class Comment_sample(db.Model):
     comment = db.Column(db.Text, nullable=False)
     date = db.Column(db.TIMESTAMP(timezone=False), nullable=False, default=datetime.now())
 
-    sampleid = db.Column(db.Integer, db.ForeignKey('sample.id'), nullable=False)
+    sampleid = db.Column(db.Integer, db.ForeignKey('sample.id'), nullable=False, index=True)
     sample = relationship("Sample", back_populates="comments")
 
     userid = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -294,13 +606,24 @@ class Comment_sample(db.Model):
 
 
 class Var2Sample(db.Model):
-    variant_ID = db.Column(db.Text, db.ForeignKey('variant.id'), primary_key=True)
+    # A fixed number of partitions by hash of the sample (see
+    # `createPartitions`), created once: no DDL when samples are added or
+    # deleted
+    __table_args__ = (
+        db.Index("ix_var2sample_sample_hide", "sample_ID", "hide"),
+        db.Index("ix_var2sample_sample_revision", "sample_ID", "revision"),
+        {"postgresql_partition_by": 'HASH ("sample_ID")'}
+    )
+
+    variant_key = db.Column(db.BigInteger, db.ForeignKey('variant.key'), primary_key=True)
     sample_ID = db.Column(db.Integer, db.ForeignKey('sample.id'), primary_key=True)
     depth = db.Column(db.Integer, nullable=True, unique=False)
     allelic_depth = db.Column(db.Integer, nullable=True, unique=False)
     filter = db.Column(MutableList.as_mutable(db.ARRAY(db.String(30))), default=list())
     reported = db.Column(db.Boolean, nullable=False, unique=False, default=False)
     hide = db.Column(db.Boolean, nullable=False, unique=False, default=False)
+    # Revision of the sample at the last change of the row
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     sample = db.relationship(Sample, backref="variants")
     variant = db.relationship(Variant, backref="samples")
@@ -317,6 +640,193 @@ class Var2Sample(db.Model):
         else:
             return True
 
+    @staticmethod
+    def touch(*criteria):
+        """
+        Mark rows as changed: increment the revision of their samples and
+        set it on the rows, for the clients to fetch only the rows changed
+        since the revision they hold (see `json_variants`).
+
+        Args:
+            *criteria: The SQL criteria selecting the rows.
+        """
+        samples = select(Var2Sample.sample_ID).where(*criteria)
+        db.session.execute(
+            update(Sample).where(Sample.id.in_(samples))
+            .values(revision=Sample.revision + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            update(Var2Sample).where(Var2Sample.sample_ID == Sample.id, *criteria)
+            .values(revision=Sample.revision)
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def createPartitions(connection, count=None):
+        """
+        Create the partitions of the table, `var2sample_p<remainder>`.
+
+        Args:
+            connection: The connection to execute the DDL with.
+            count (int): The number of partitions. Default is
+                         `VAR2SAMPLE_PARTITIONS`.
+        """
+        count = int(count or app.config.get("VAR2SAMPLE_PARTITIONS", 32))
+        for remainder in range(count):
+            connection.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS var2sample_p{remainder} "
+                f"PARTITION OF var2sample "
+                f"FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})"
+            )
+
+
+@event.listens_for(Var2Sample.__table__, "after_create")
+def create_var2sample_partitions(target, connection, **kw):
+    Var2Sample.createPartitions(connection)
+
+
+class Occurrence(db.Model):
+    variant_key = db.Column(db.BigInteger, db.ForeignKey('variant.key'), primary_key=True)
+    carriers = db.Column(db.Integer, nullable=False, default=0)
+    validated = db.Column(db.Integer, nullable=False, default=0)
+    affected = db.Column(db.Integer, nullable=False, default=0)
+    unaffected = db.Column(db.Integer, nullable=False, default=0)
+
+    variant = db.relationship(Variant, backref=db.backref("occurrence", uselist=False))
+
+    def __repr__(self):
+        return f"Occurrence('{self.variant_key}','{self.carriers}')"
+
+    def __str__(self):
+        return f"{self.variant_key} ({self.carriers})"
+
+    @staticmethod
+    def sample_state(sample):
+        """
+        Get what a sample counts for in the occurrences of its variants.
+
+        Args:
+            sample (Sample): The sample.
+
+        Returns:
+            dict: validated (bool), affected (bool) and team_ids (set).
+        """
+        return {
+            "validated": int(sample.status) >= 4,
+            "affected": bool(sample.affected),
+            "team_ids": {team.id for team in sample.teams}
+        }
+
+    @staticmethod
+    def count_sample(sample, sign=1, state=None, variant_keys=None):
+        """
+        Add (or remove with `sign=-1`) a sample to the occurrences of its
+        variants, with one statement by table.
+
+        Args:
+            sample (Sample): The sample.
+            sign (int): 1 to add the sample, -1 to remove it. Default is 1.
+            state (dict): The state of the sample to count (see
+                          `sample_state`). Default is the current one.
+            variant_keys (list): Count only these variants (keys) of the
+                                 sample.
+                                Default is all of them.
+        """
+        state = state if state is not None else Occurrence.sample_state(sample)
+        rows = select(
+            Var2Sample.variant_key,
+            literal(sign),
+            literal(sign if state["validated"] else 0),
+            literal(sign if state["affected"] else 0),
+            literal(0 if state["affected"] else sign)
+        ).where(Var2Sample.sample_ID == sample.id)
+        if variant_keys is not None:
+            rows = rows.where(Var2Sample.variant_key.in_(variant_keys))
+        # Rows locked in the same order by concurrent imports, not to deadlock
+        rows = rows.order_by(Var2Sample.variant_key)
+        columns = ["variant_key", "carriers", "validated", "affected", "unaffected"]
+        stmt = postgresql.insert(Occurrence.__table__).from_select(columns, rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["variant_key"],
+            set_={c: Occurrence.__table__.c[c] + stmt.excluded[c] for c in columns[1:]}
+        )
+        db.session.execute(stmt)
+
+        for team_id in state["team_ids"]:
+            rows = select(
+                Var2Sample.variant_key, literal(team_id), literal(sign)
+            ).where(Var2Sample.sample_ID == sample.id)
+            if variant_keys is not None:
+                rows = rows.where(Var2Sample.variant_key.in_(variant_keys))
+            rows = rows.order_by(Var2Sample.variant_key)
+            stmt = postgresql.insert(Occurrence_team.__table__).from_select(
+                ["variant_key", "team_ID", "carriers"], rows
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["variant_key", "team_ID"],
+                set_={"carriers": Occurrence_team.__table__.c.carriers + stmt.excluded.carriers}
+            )
+            db.session.execute(stmt)
+
+    @staticmethod
+    def update_sample(sample, old_state):
+        """
+        Move a sample in the occurrences of its variants after a change of
+        its status, affected state or teams.
+
+        Args:
+            sample (Sample): The sample, in its new state.
+            old_state (dict): The state of the sample before the change (see
+                              `sample_state`).
+        """
+        new_state = Occurrence.sample_state(sample)
+        if new_state != old_state:
+            Occurrence.count_sample(sample, -1, old_state)
+            Occurrence.count_sample(sample, 1, new_state)
+
+    @staticmethod
+    def recount():
+        """
+        Rebuild all the occurrences from `Var2Sample`.
+        """
+        db.session.query(Occurrence_team).delete()
+        db.session.query(Occurrence).delete()
+
+        rows = select(
+            Var2Sample.variant_key,
+            func.count(),
+            func.count().filter(Sample.status >= 4),
+            func.count().filter(Sample.affected == True),
+            func.count().filter(or_(Sample.affected == False, Sample.affected == None))
+        ).join(Sample, Var2Sample.sample_ID == Sample.id).group_by(Var2Sample.variant_key)
+        db.session.execute(postgresql.insert(Occurrence.__table__).from_select(
+            ["variant_key", "carriers", "validated", "affected", "unaffected"], rows
+        ))
+
+        rows = select(
+            Var2Sample.variant_key, sample2team.c.team_ID, func.count()
+        ).join(
+            sample2team, sample2team.c.sample_ID == Var2Sample.sample_ID
+        ).group_by(Var2Sample.variant_key, sample2team.c.team_ID)
+        db.session.execute(postgresql.insert(Occurrence_team.__table__).from_select(
+            ["variant_key", "team_ID", "carriers"], rows
+        ))
+
+
+class Occurrence_team(db.Model):
+    variant_key = db.Column(db.BigInteger, db.ForeignKey('variant.key'), primary_key=True)
+    team_ID = db.Column(db.Integer, db.ForeignKey('team.id'), primary_key=True)
+    carriers = db.Column(db.Integer, nullable=False, default=0)
+
+    team = db.relationship(Team)
+
+    def __repr__(self):
+        return f"Occurrence_team('{self.variant_key}','{self.team_ID}')"
+
+    def __str__(self):
+        return f"{self.variant_key} - {self.team} ({self.carriers})"
+
 
 team2filter = db.Table(
     'team2filter',
@@ -332,9 +842,13 @@ team2filter = db.Table(
 
 
 class Filter(db.Model):
+    __table_args__ = (
+        db.Index("ix_filter_filter", "filter", postgresql_using="gin"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filtername = db.Column(db.String(20), unique=True, nullable=False)
-    filter = db.Column(db.JSON, nullable=True)
+    filter = db.Column(postgresql.JSONB, nullable=True)
     samples = relationship("Sample")
 
     teams = db.relationship(
@@ -378,7 +892,8 @@ region2bed = db.Table(
     db.Column(
         'bed_ID', db.Integer,
         db.ForeignKey('bed.id'), primary_key=True
-    )
+    ),
+    db.Index("ix_region2bed_bed", "bed_ID")
 )
 
 team2bed = db.Table(
@@ -401,6 +916,23 @@ class Region(db.Model):
     start = db.Column(db.Integer, unique=False, nullable=False)
     stop = db.Column(db.Integer, unique=False, nullable=False)
 
+    __table_args__ = (
+        db.Index(
+            "ix_region_interval",
+            func.int4range(start, stop, literal_column("'[]'")),
+            postgresql_using="gist"
+        ),
+    )
+
+    @hybrid_property
+    def interval(self):
+        return (self.start, self.stop)
+
+    @interval.expression
+    def interval(cls):
+        # Indexed with GiST, test a position with `Region.interval.op("@>")(pos)`
+        return func.int4range(cls.start, cls.stop, literal_column("'[]'"))
+
     def __repr__(self):
         return f"Region('{self.name}','{self.chr}','{self.start}','{self.stop}')"
 
@@ -435,11 +967,52 @@ class Bed(db.Model):
     def __str__(self):
         return self.name
 
+    def intervals(self):
+        """
+        Get the regions of the bed merged and sorted by chromosome, built once
+        and cached until the regions of a bed change.
+
+        Returns:
+            dict: By chromosome, the sorted starts and the stops of the merged
+                  regions.
+        """
+        index = bed_intervals.get(self.id)
+        if index is None:
+            regions = dict()
+            for region in self.regions:
+                regions.setdefault(region.chr, list()).append((region.start, region.stop))
+            index = dict()
+            for chr, chr_regions in regions.items():
+                starts, stops = list(), list()
+                for start, stop in sorted(chr_regions):
+                    if stops and start <= stops[-1] + 1:
+                        stops[-1] = max(stops[-1], stop)
+                    else:
+                        starts.append(start)
+                        stops.append(stop)
+                index[chr] = (starts, stops)
+            bed_intervals[self.id] = index
+        return index
+
     def varInBed(self, variant):
-        for region in self.regions:
-            if region.varInRegion(variant):
-                return True
-        return False
+        starts, stops = self.intervals().get(variant.chr, ([], []))
+        idx = bisect.bisect_right(starts, variant.pos) - 1
+        return idx >= 0 and variant.pos <= stops[idx]
+
+
+# Intervals of the beds, by bed id (see `Bed.intervals`)
+bed_intervals = dict()
+
+
+@event.listens_for(Session, "after_flush")
+def clear_bed_intervals(session, flush_context):
+    """
+    Invalidate the cached intervals of the beds when regions or beds change.
+    """
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (Region, Bed)):
+            bed_intervals.clear()
+            return
 
 
 class Lane(db.Model):
@@ -552,6 +1125,11 @@ phenotype2OMIM = db.Table(
 
 
 class Omim(db.Model):
+    __table_args__ = (
+        db.Index("ix_omim_genesymbols", "geneSymbols", postgresql_using="gin"),
+        db.Index("ix_omim_approvedgenesymbol", "approvedGeneSymbol"),
+    )
+
     mimNumber = db.Column(db.Integer, primary_key=True)
     approvedGeneSymbol = db.Column(db.String(50))
     comments = db.Column(db.Text)
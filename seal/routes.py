@@ -19,9 +19,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import functools
+import gzip
+import itertools
 import json
 import secrets
 import urllib
+import zlib
 
 from datetime import datetime
 from pathlib import Path
@@ -30,22 +33,32 @@ from threading import Thread
 
 from PIL import Image
 from flask import (flash, jsonify, redirect, render_template, request, url_for,
-                   escape, abort)
+                   escape, abort, stream_with_context)
 from flask_login import current_user, login_user, logout_user
 from flask_login.utils import EXEMPT_METHODS
 from flask_wtf.csrf import CSRFError
-from sqlalchemy import and_, or_
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, or_, exists, func, select, cast, false
+from sqlalchemy.orm import aliased, contains_eager, defer, with_expression
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from psycopg2.errors import UniqueViolation
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from seal import app, bcrypt, db
+from seal.cache import variants_cache
 from seal.forms import (AddCommentForm, LoginForm, SaveFilterForm,
                         UploadPanelForm, UploadVariantForm,
                         UpdateAccountForm, UpdatePasswordForm, UploadClinvar)
 from seal.models import (Bed, Comment_sample, Comment_variant, Family, Filter,
                          History, Omim, Region, Run, Sample, Team,
-                         Transcript, User, Variant, Var2Sample, Clinvar)
-from seal.schedulers import update_clinvar_thread
+                         Transcript, User, Variant, Var2Sample, Clinvar,
+                         Occurrence, Occurrence_team, Annotation, region2bed)
+from seal.schedulers import (update_clinvar_thread, get_import_jobs,
+                             select_main_annotation)
+from seal.filters import (JSONPath, annotations_clause, compile_criteria,
+                          parse_nested_form)
 
 
 ###############################################################################
@@ -370,6 +383,570 @@ def add_vcf(info, vcf_file):
     return vcf_fn
 
 
+def main_annotation(annotations, transcripts):
+    """
+    Get the main annotation of a variant for the user: the main annotation
+    selected at import, or the best annotation among the preferred
+    transcripts of the user if the variant has some.
+
+    Args:
+        annotations (dict): The annotations of a version (`ANN` and `main`).
+        transcripts (set): The preferred transcripts of the user.
+
+    Returns:
+        dict: A copy of the main annotation, with `preferred` set.
+    """
+    preferred = list()
+    if transcripts:
+        preferred = [annot for annot in annotations["ANN"] if annot['Feature'] in transcripts]
+
+    if preferred:
+        main_annot = preferred[select_main_annotation(preferred)]
+    else:
+        main = annotations.get("main")
+        if main is None:
+            # Variants imported before the main annotation was stored
+            main = select_main_annotation(annotations["ANN"])
+        main_annot = annotations["ANN"][main] if main is not None else None
+
+    if main_annot is None:
+        return None
+    return dict(main_annot, preferred=bool(preferred))
+
+
+def phenotype_json(pheno):
+    """Serialize an OMIM phenotype for the variants table."""
+    return {
+        "id": pheno.id,
+        "phenotypeMimNumber": pheno.phenotypeMimNumber,
+        "phenotype": pheno.phenotype,
+        "inheritances": str(pheno.inheritances),
+        "phenotypeMappingKey": pheno.phenotypeMappingKey
+    }
+
+
+def variants_json(var2samples, sample, version=-1, fields=None):
+    """
+    Serialize variants of a sample as displayed in the variants table.
+
+    Occurrences, OMIM phenotypes and family genotypes are fetched for all the
+    variants at once, so the number of queries does not depend on the number
+    of variants.
+
+    Args:
+        var2samples (list): The variants of the sample (Var2Sample, with their
+                            variant loaded).
+        sample (Sample): The sample.
+        version (int): The version of the annotations. Default is -1.
+        fields (iterable): The fields of the main annotations to send.
+                           Default is None, all of them.
+
+    Returns:
+        list: The variants, see `json_variants`.
+    """
+    var2samples = list(var2samples)
+    if not var2samples:
+        return list()
+    keys = [v2s.variant_key for v2s in var2samples]
+    transcripts = set(current_user.transcripts or list())
+
+    main_annots = {
+        v2s.variant_key: main_annotation(
+            v2s.variant.projected_version or v2s.variant.annotationVersion(version),
+            transcripts
+        )
+        for v2s in var2samples
+    }
+
+    occurrences = dict(
+        db.session.query(Occurrence.variant_key, Occurrence.carriers)
+        .filter(Occurrence.variant_key.in_(keys))
+    )
+
+    symbols = {annot["SYMBOL"] for annot in main_annots.values() if annot and annot["SYMBOL"]}
+    phenotypes = {symbol: list() for symbol in symbols}
+    if symbols:
+        omims = Omim.query.filter(or_(
+            Omim.geneSymbols.overlap(list(symbols)),
+            Omim.approvedGeneSymbol.in_(symbols)
+        )).order_by(Omim.mimNumber)
+        for omim in omims:
+            for symbol in symbols & ({omim.approvedGeneSymbol} | set(omim.geneSymbols or list())):
+                phenotypes[symbol] += [phenotype_json(pheno) for pheno in omim.phenotypes]
+
+    relatives = list()
+    genotypes = dict()
+    if sample.familyid is not None:
+        relatives = [s for s in sample.family.samples if s != sample]
+        for v2s in Var2Sample.query.filter(
+            Var2Sample.sample_ID.in_([s.id for s in relatives]),
+            Var2Sample.variant_key.in_(keys)
+        ):
+            genotypes[(v2s.variant_key, v2s.sample_ID)] = v2s
+
+    variants = list()
+    for var2sample in var2samples:
+        variant = var2sample.variant
+        main_annot = main_annots[variant.key]
+
+        members = []
+        t = dict()
+        for s in relatives:
+            req = genotypes.get((variant.key, s.id))
+            if req:
+                t[str(s)] = {
+                    "depth": f"{req.depth}",
+                    "allelic_depth": f"{req.allelic_depth}",
+                    "allelic_frequency": f"{(req.allelic_depth / req.depth):.4f}",
+                }
+                if s.status >= 1:
+                    members.append(s.samplename)
+            else:
+                t[str(s)] = {
+                    "depth": f"NA",
+                    "allelic_depth": f"NA",
+                    "allelic_frequency": f"NA",
+                }
+
+        allelic_frequency = var2sample.allelic_depth / var2sample.depth
+
+        variants.append({
+            "annotations": project_annotation(main_annot, fields),
+            "chr": f"{variant.chr}",
+            "clinvar": {
+                "VARID" : variant.clinvar_VARID,
+                "CLNSIG" : variant.clinvar_CLNSIG,
+                "CLNSIGCONF" : variant.clinvar_CLNSIGCONF,
+                "CLNREVSTAT" : variant.clinvar_CLNREVSTAT
+            },
+            "id": f"{variant.id}",
+            "pos": f"{variant.pos}",
+            "ref": f"{variant.ref}",
+            "alt": f"{variant.alt}",
+            "filter": var2sample.filter,
+            "depth": f"{var2sample.depth}",
+            "reported": var2sample.reported,
+            "class_variant": variant.class_variant,
+            "allelic_depth": f"{var2sample.allelic_depth}",
+            "allelic_frequency": f"{allelic_frequency:.4f}",
+            "inseal": {
+                "occurrences": occurrences.get(variant.key, 0),
+                "occurences_family": len(members),
+                "family_members": members
+            },
+            "phenotypes": phenotypes.get(main_annot["SYMBOL"], list()) if main_annot else list(),
+            "family": t
+        })
+
+    return variants
+
+
+def variant_in_bed(bed_id):
+    """
+    SQL clause selecting the variants located in a region of a bed.
+
+    Args:
+        bed_id (int): The ID of the bed.
+
+    Returns:
+        sqlalchemy.sql.expression.Exists: The clause to filter on.
+    """
+    return exists().where(
+        region2bed.c.bed_ID == bed_id,
+        region2bed.c.region_ID == Region.id,
+        Region.chr == Variant.chr,
+        Region.interval.op("@>")(Variant.pos)
+    )
+
+
+def response_encoding():
+    """
+    Choose the compression of a response among the ones accepted by the
+    client: brotli (if installed), else gzip.
+
+    Returns:
+        str: The content encoding, None if the client accepts none.
+    """
+    return request.accept_encodings.best_match(
+        ["br", "gzip"] if brotli is not None else ["gzip"]
+    )
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compress the chunks of a streamed response, each chunk being flushed to
+    be sent at once.
+
+    Args:
+        chunks (iterable): The chunks (str or bytes).
+        encoding (str): The content encoding, "br" or "gzip".
+
+    Returns:
+        generator: The compressed chunks.
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+        flush = functools.partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield process(chunk) + flush()
+    yield finish()
+
+
+@app.after_request
+def compress_json(response):
+    """
+    Compress the responses of the JSON endpoints (`/json/*`) as negotiated
+    with the client: the streamed ones chunk by chunk, the others if larger
+    than `JSON_COMPRESSION_MIN_SIZE` bytes. The responses already compressed
+    (e.g. cached, see `gzip_response`) are left as is.
+
+    Args:
+        response (flask.Response): The response.
+
+    Returns:
+        flask.Response: The response, compressed if needed.
+    """
+    if (not request.path.startswith("/json/") or response.status_code != 200
+            or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < app.config.get("JSON_COMPRESSION_MIN_SIZE", 1024):
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=5))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def gzip_response(payload):
+    """
+    Build the response of a gzipped JSON payload, sent compressed if the
+    client accepts gzip, to not compress it again.
+
+    Args:
+        payload (bytes): The gzipped JSON payload.
+
+    Returns:
+        flask.Response: The response.
+    """
+    if "gzip" not in request.accept_encodings:
+        return app.response_class(gzip.decompress(payload), mimetype="application/json")
+    response = app.response_class(payload, mimetype="application/json")
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def annotation_fields(default=None):
+    """
+    Get the fields of the annotations requested by the client (`fields`,
+    repeated or comma-separated, `all` for all of them), to send only the
+    annotation columns the table shows.
+
+    Args:
+        default (list): The fields to send if the client requests none.
+                        Default is None, all of them.
+
+    Returns:
+        tuple: The sorted fields, None to send all of them.
+    """
+    fields = {
+        field.strip()
+        for value in request.values.getlist("fields")
+        for field in value.split(",") if field.strip()
+    }
+    if "all" in fields:
+        return None
+    fields = fields or set(default or list())
+    return tuple(sorted(fields)) if fields else None
+
+
+def project_annotation(annotation, fields=None):
+    """
+    Restrict an annotation to some fields.
+
+    Args:
+        annotation (dict): The annotation (can be None).
+        fields (iterable): The fields to keep. Default is None, all of them.
+
+    Returns:
+        dict: The annotation with the fields only, null if missing (as
+              loaded by `Variant.projectedVersion`).
+    """
+    if annotation is None or fields is None:
+        return annotation
+    return {field: annotation.get(field) for field in fields}
+
+
+# Fields of the annotations selecting the main annotation (see
+# `main_annotation`) and its phenotypes
+MAIN_ANNOTATION_FIELDS = {"BIOTYPE", "Feature", "SOURCE", "SYMBOL", "canonical", "consequenceScore"}
+
+
+def load_annotation_fields(var2samples, fields, version=-1):
+    """
+    Load only some fields of the annotations of the variants, and the ones
+    selecting the main annotation, see `Variant.projectedVersion`. Only the
+    last version is read so, the older ones are rebuilt in full from the
+    newer versions.
+
+    Args:
+        var2samples (Query): The variants of a sample (Var2Sample joined to
+                             their variant).
+        fields (iterable): The fields. None to load all of them.
+        version (int): The version of the annotations. Default is -1.
+
+    Returns:
+        Query: The variants of the sample.
+    """
+    if fields is None or version != -1:
+        return var2samples
+    return var2samples.options(
+        contains_eager(Var2Sample.variant).defer(Variant.annotations),
+        contains_eager(Var2Sample.variant).with_expression(
+            Variant.projected_version,
+            Variant.projectedVersion(sorted(set(fields) | MAIN_ANNOTATION_FIELDS))
+        )
+    )
+
+
+# Rows fetched from the database and serialized at once by the streamed
+# responses
+STREAM_BATCH = 1000
+
+# Compact JSON encoder (with the C accelerator) for the streamed rows
+stream_encoder = json.JSONEncoder(separators=(",", ":"), default=app.json.default)
+
+
+def batches(rows, size=STREAM_BATCH):
+    """
+    Split rows in lists of rows.
+
+    Args:
+        rows (iterable): The rows.
+        size (int): The number of rows of the lists. Default is
+                    `STREAM_BATCH`.
+
+    Returns:
+        generator: The lists of rows.
+    """
+    rows = iter(rows)
+    batch = list(itertools.islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(rows, size))
+
+
+def stream_json(rows, fields=None, on_complete=None, max_size=None):
+    """
+    Build a response streaming a JSON object holding rows (`data`), encoded
+    by batches while they are fetched: the memory does not depend on the
+    number of rows and the client receives the first rows at once.
+
+    Args:
+        rows (iterable): The rows (JSON serializable), usually read from a
+                         server-side cursor (`yield_per`).
+        fields (dict): The other keys of the object. Default is None.
+        on_complete (callable): Called with the whole payload gzipped
+                                (bytes) once streamed, e.g. to cache it. The
+                                payload is compressed while streamed. Default
+                                is None.
+        max_size (int): The maximum size of the gzipped payload, beyond it
+                        is not kept and `on_complete` is not called. Default
+                        is None, no maximum.
+
+    Returns:
+        flask.Response: The response.
+    """
+    def generate():
+        compressor = parts = None
+        size = 0
+        if on_complete is not None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            parts = list()
+
+        def keep(chunk):
+            nonlocal compressor, parts, size
+            if compressor is None:
+                return
+            part = compressor.compress(chunk.encode())
+            size += len(part)
+            if max_size is not None and size > max_size:
+                compressor = parts = None
+                return
+            parts.append(part)
+
+        head = stream_encoder.encode(fields or dict())[:-1]
+        chunk = head + ("," if len(head) > 1 else "") + '"data":['
+        for count, batch in enumerate(batches(rows)):
+            chunk += ("," if count else "") + ",".join(map(stream_encoder.encode, batch))
+            keep(chunk)
+            yield chunk
+            chunk = ""
+        chunk += "]}"
+        keep(chunk)
+        yield chunk
+        if compressor is not None:
+            part = compressor.flush()
+            if max_size is None or size + len(part) <= max_size:
+                parts.append(part)
+                on_complete(b"".join(parts))
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/json")
+
+
+def invalidate_family(sample):
+    """
+    Invalidate the cached variants of a sample and of its relatives, which
+    show its genotypes.
+
+    Args:
+        sample (Sample): The sample.
+    """
+    sample_ids = {sample.id}
+    if sample.family is not None:
+        sample_ids.update(s.id for s in sample.family.samples)
+    variants_cache.invalidate(sample_ids)
+
+
+def variants_changes(sample, since, bed_id=None, version=-1, fields=None):
+    """
+    Serialize the variants of a sample changed since a revision, for the
+    client to patch its table instead of reloading it.
+
+    Args:
+        sample (Sample): The sample.
+        since (int): The revision of the sample held by the client.
+        bed_id (int): The ID of the bed to restrict the variants to. Default
+                      is None.
+        version (int): The version of the annotations. Default is -1.
+        fields (iterable): The fields of the main annotations to send.
+                           Default is None, all of them.
+
+    Returns:
+        dict: The current revision of the sample (`revision`), the changed
+              variants to show (`data`, see `json_variants`) and the IDs of
+              the changed variants to hide (`removed`).
+    """
+    changed = Var2Sample.query.join(Variant, Var2Sample.variant).options(
+        contains_eager(Var2Sample.variant)
+    ).filter(
+        Var2Sample.sample_ID == sample.id,
+        Var2Sample.revision > since
+    )
+    if bed_id is not None:
+        changed = changed.filter(variant_in_bed(bed_id))
+    changed = load_annotation_fields(changed, fields, version).all()
+    return {
+        "revision": sample.revision,
+        "data": variants_json([v2s for v2s in changed if not v2s.hide], sample, version, fields),
+        "removed": [v2s.variant.id for v2s in changed if v2s.hide]
+    }
+
+
+# The main annotation of the variants, joined to filter and sort on it
+MainAnnotation = aliased(Annotation, name="main_annotation")
+
+
+def main_annotation_clause(transcripts, version=-1):
+    """
+    SQL clause joining `MainAnnotation` to the variants, as selected by
+    `main_annotation`: the main annotation stored at import, or the best
+    annotation among the preferred transcripts of the user.
+
+    Args:
+        transcripts (set): The preferred transcripts of the user.
+        version (int): The version of the annotations. Default is -1.
+
+    Returns:
+        sqlalchemy.sql.elements.ClauseElement: The join condition.
+    """
+    other = aliased(Annotation)
+    if version < 0:
+        version = select(
+            func.max(other.version) + 1 + version
+        ).where(other.variant_key == Variant.key).scalar_subquery()
+    clause = and_(MainAnnotation.variant_key == Variant.key, MainAnnotation.version == version)
+    if not transcripts:
+        return and_(clause, MainAnnotation.main)
+
+    other = aliased(Annotation)
+    best = select(other.rank).where(
+        other.variant_key == MainAnnotation.variant_key,
+        other.version == MainAnnotation.version
+    ).order_by(
+        func.coalesce(other.feature.in_(list(transcripts)), false()).desc(),
+        func.coalesce(other.source == "RefSeq", false()).desc(),
+        func.coalesce(other.biotype == "protein_coding", false()).desc(),
+        other.canonical.desc(),
+        other.consequence_score.desc(),
+        other.rank.asc()
+    ).limit(1).scalar_subquery()
+    return and_(clause, MainAnnotation.rank == best)
+
+
+def count_hidden(sample):
+    """
+    Count the hidden variants of a sample in its panel, with one query.
+
+    Args:
+        sample (Sample): The sample.
+
+    Returns:
+        int: The number of hidden variants (in the panel of the sample if it
+             has one).
+    """
+    query = db.session.query(func.count()).select_from(Var2Sample).filter(
+        Var2Sample.sample_ID == sample.id,
+        Var2Sample.hide == True
+    )
+    if sample.bed_id is not None:
+        query = query.join(Variant, Var2Sample.variant).filter(variant_in_bed(sample.bed_id))
+    return query.scalar()
+
+
+# Columns of the variants table sortable server-side (by DataTables data)
+VARIANTS_ORDER = {
+    "id": Variant.id,
+    "chr": Variant.chr,
+    "pos": Variant.pos,
+    "class_variant": Variant.class_variant,
+    "clinvar": Variant.clinvar_CLNSIG,
+    "filter": Var2Sample.filter,
+    "depth": Var2Sample.depth,
+    "allelic_depth": Var2Sample.allelic_depth,
+    "allelic_frequency": Var2Sample.allelic_depth / func.nullif(Var2Sample.depth, 0).cast(db.Float),
+    "reported": Var2Sample.reported,
+    "annotations.SYMBOL": MainAnnotation.symbol,
+    "annotations.HGVSg": MainAnnotation.hgvsg,
+    "annotations.HGVSp": MainAnnotation.hgvsp,
+    "annotations.HGVSc": MainAnnotation.hgvsc,
+    "annotations.gnomADg_AF": MainAnnotation.gnomadg_af,
+    "annotations.IMPACT": MainAnnotation.impact,
+    "annotations.MES_var": func.abs(MainAnnotation.mes_var),
+    "annotations.spliceAI": MainAnnotation.spliceai,
+    "annotations.missensesMean": MainAnnotation.missenses_mean,
+    "annotations.Feature": MainAnnotation.feature
+}
+
+
 ###############################################################################
 
 
@@ -629,11 +1206,7 @@ def sample(id):
     saveFilterForm.teams.choices = choices
     saveFilterForm.teams.data = [team.id for team in current_user.teams]
 
-    count_hide=0
-
-    for v in  Var2Sample.query.filter(Var2Sample.sample_ID == id, Var2Sample.hide == True):
-        if v.inBed():
-            count_hide+=1
+    count_hide = count_hidden(sample)
 
     family_members = []
     if sample.family:
@@ -643,9 +1216,14 @@ def sample(id):
 
     clinvar = Clinvar.query.filter(Clinvar.genome == "grch37", Clinvar.current == True).one()
 
+    variants_count = Var2Sample.query.filter(Var2Sample.sample_ID == id).count()
+    server_side = variants_count > app.config.get("VARIANTS_SERVER_SIDE", 20000)
+
     return render_template(
         'analysis/sample.html', title=f'{sample.samplename}',
         sample=sample,
+        variants_count = variants_count,
+        server_side = server_side,
         count_hide = count_hide,
         family_members = family_members,
         form=commentForm,
@@ -1022,6 +1600,27 @@ def json_variants(id, idbed=False, version=-1):
                                       within the same family.
                 - family_members: A list of family members with the variant.
             - phenotypes: A list of phenotypes associated with the variant.
+
+        When the request holds DataTables server-side parameters (`draw`,
+        `start`, `length`, `search[value]`, `order[0][column]`,
+        `order[0][dir]`), only the requested page of variants is returned,
+        sorted and searched in database, with the keys `draw`,
+        `recordsTotal` and `recordsFiltered`. The SearchBuilder criteria
+        (`searchBuilder`) or the criteria of a saved filter (`filter`, its
+        id) are applied server-side too, see `seal.filters`: the columns of
+        the main annotation are filtered and sorted on the `Annotation`
+        table, a 400 error is returned if the saved filter does not exist. A
+        SQL/JSON path on the annotation versions of the variants
+        (`jsonpath`) filters them too, a 400 error is returned if it is
+        invalid.
+
+        Without server-side parameters, the variants are streamed, see
+        `stream_json`. Only the fields of the main annotations listed in
+        `fields` (default is `VARIANTS_ANNOTATION_FIELDS`, the columns of the
+        table, `all` for all of them) are read and sent, see
+        `annotation_fields`. The revision of the sample is returned with the
+        variants (`revision`). Given a revision (`since`), only the variants changed
+        since are returned, see `variants_changes`.
     """
     sample = Sample.query.get(int(id))
     if not sample:
@@ -1029,176 +1628,116 @@ def json_variants(id, idbed=False, version=-1):
               category="error")
         return redirect(url_for('index'))
 
-    if idbed >= 1:
-        bed = Bed.query.get(int(idbed))
+    # Only the id of the bed is needed, do not load its regions
+    bed_id = None
+    if idbed and idbed >= 1:
+        bed_id = db.session.query(Bed.id).filter(Bed.id == int(idbed)).scalar()
 
-    variants = {"data": list()}
+    variants = Var2Sample.query.join(Variant, Var2Sample.variant).options(
+        contains_eager(Var2Sample.variant)
+    ).filter(
+        Var2Sample.sample_ID == sample.id,
+        Var2Sample.hide == False
+    )
+    if bed_id is not None:
+        variants = variants.filter(variant_in_bed(bed_id))
+
+    fields = annotation_fields(app.config.get("VARIANTS_ANNOTATION_FIELDS"))
+    since = request.values.get("since", type=int)
+    if since is not None:
+        return jsonify(variants_changes(sample, since, bed_id, version, fields))
+
+    if "draw" not in request.form:
+        key = (sample.id, bed_id, version, tuple(sorted(current_user.transcripts or list())), fields)
+        payload = variants_cache.get(key)
+        if payload is not None:
+            return gzip_response(payload)
+        # Serialized by batches (see `variants_json`) from a server-side cursor
+        rows = itertools.chain.from_iterable(
+            variants_json(batch, sample, version, fields)
+            for batch in batches(
+                load_annotation_fields(variants, fields, version).yield_per(STREAM_BATCH)
+            )
+        )
+        # Not cached if the sample changes while the payload is streamed
+        generation = variants_cache.generation(sample.id)
+        return stream_json(
+            rows, {"revision": sample.revision},
+            functools.partial(variants_cache.store, key, generation=generation)
+            if variants_cache.max_size else None,
+            variants_cache.max_size
+        )
 
-    # Get all canonical trancripts
+    # Server-side processing (DataTables protocol)
+    recordsTotal = variants.count()
+    transcripts = set(current_user.transcripts or list())
+    variants = variants.outerjoin(MainAnnotation, main_annotation_clause(transcripts, version))
 
-    ##################################################
+    search = request.form.get('search[value]', '')
+    if search:
+        variants = variants.filter(or_(
+            Variant.id.op('~')(search),
+            Variant.clinvar_CLNSIG.op('~')(search)
+        ))
 
-    for var2sample in sample.variants:
-        variant = var2sample.variant
+    jsonpath = request.form.get("jsonpath")
+    if jsonpath:
         try:
-            if bed and not bed.varInBed(variant):
-                continue
-        except NameError:
-            pass
-        if var2sample.hide:
-            continue
-        annotations = variant.annotations
-        main_annot = None
-        consequence_score = -999
-        canonical = False
-        refseq = False
-        protein_coding = False
-        preferred_transcript = False
-
-        for annot in annotations[version]["ANN"]:
-            current_consequence_score = annot['consequenceScore']
-            current_canonical = annot['canonical']
-            current_refseq = True if annot['SOURCE'] == 'RefSeq' else False
-            current_protein_coding = True if annot['BIOTYPE'] == 'protein_coding' else False
-            current_preferred_transcript = True if annot['Feature'] in current_user.transcripts else False
-
-            if preferred_transcript == current_preferred_transcript:
-                if refseq == current_refseq:
-                    if current_protein_coding and not protein_coding:
-                        canonical = current_canonical
-                        consequence_score = current_consequence_score
-                        refseq = current_refseq
-                        protein_coding = current_protein_coding
-                        preferred_transcript = current_preferred_transcript
-                        annot["preferred"] = preferred_transcript
-                        main_annot = annot
-                        continue
-                    if protein_coding and not current_protein_coding:
-                        continue
-                    if canonical and not current_canonical:
-                        continue
-                    if not canonical and current_canonical:
-                        canonical = current_canonical
-                        consequence_score = current_consequence_score
-                        refseq = current_refseq
-                        protein_coding = current_protein_coding
-                        preferred_transcript = current_preferred_transcript
-                        annot["preferred"] = preferred_transcript
-                        main_annot = annot
-                        continue
-                    if current_consequence_score > consequence_score:
-                        canonical = current_canonical
-                        consequence_score = current_consequence_score
-                        refseq = current_refseq
-                        protein_coding = current_protein_coding
-                        preferred_transcript = current_preferred_transcript
-                        annot["preferred"] = preferred_transcript
-                        main_annot = annot
-                        continue
-                    continue
-
-                if current_refseq:
-                    canonical = current_canonical
-                    consequence_score = current_consequence_score
-                    refseq = current_refseq
-                    protein_coding = current_protein_coding
-                    preferred_transcript = current_preferred_transcript
-                    annot["preferred"] = preferred_transcript
-                    main_annot = annot
-                    continue
-                continue
-
-            if current_preferred_transcript:
-                canonical = current_canonical
-                consequence_score = current_consequence_score
-                refseq = current_refseq
-                protein_coding = current_protein_coding
-                preferred_transcript = current_preferred_transcript
-                annot["preferred"] = preferred_transcript
-                main_annot = annot
-                continue
-
-            if main_annot is None:
-                canonical = current_canonical
-                consequence_score = current_consequence_score
-                refseq = current_refseq
-                protein_coding = current_protein_coding
-                preferred_transcript = current_preferred_transcript
-                annot["preferred"] = preferred_transcript
-                main_annot = annot
-                continue
-        omims = Omim.query.filter(or_(Omim.geneSymbols.contains([main_annot["SYMBOL"]]), Omim.approvedGeneSymbol==main_annot["SYMBOL"])).all()
-        phenotypes = list()
-        for omim in omims:
-            for pheno in omim.phenotypes:
-                phenotypes.append({
-                    "id": pheno.id,
-                    "phenotypeMimNumber": pheno.phenotypeMimNumber,
-                    "phenotype": pheno.phenotype,
-                    "inheritances": str(pheno.inheritances),
-                    "phenotypeMappingKey": pheno.phenotypeMappingKey
-                })
-        members = []
-        t = dict()
-        if sample.familyid is not None:
-            for s in sample.family.samples:
-                if s == sample:
+            db.session.execute(select(cast(jsonpath, JSONPath())))
+        except DBAPIError:
+            db.session.rollback()
+            return jsonify({"error": f"Invalid JSON path: '{jsonpath}'"}), 400
+        variants = variants.filter(annotations_clause(jsonpath))
+
+    criteria = parse_nested_form(request.form, "searchBuilder")
+    if criteria is None and request.form.get("filter"):
+        filter_id = request.form.get("filter", type=int)
+        saved_filter = Filter.query.get(filter_id) if filter_id is not None else None
+        if saved_filter is None:
+            return jsonify({"error": f"Filter '{request.form['filter']}' not found"}), 400
+        criteria = saved_filter.filter
+    clause, predicate = compile_criteria(criteria, MainAnnotation)
+    if clause is not None:
+        variants = variants.filter(clause)
+
+    order_column = request.form.get(f"columns[{request.form.get('order[0][column]')}][data]")
+    order = [Variant.chr.asc(), Variant.pos.asc(), Variant.id.asc()]
+    if order_column in VARIANTS_ORDER:
+        key = VARIANTS_ORDER[order_column]
+        key = key.desc() if request.form.get('order[0][dir]') == "desc" else key.asc()
+        order.insert(0, key.nullslast())
+    variants = variants.order_by(*order)
+
+    start = int(request.form.get("start", 0))
+    length = int(request.form.get("length", -1))
+    if predicate is None:
+        recordsFiltered = variants.count()
+        variants = load_annotation_fields(variants, fields, version).offset(start)
+        if length >= 0:
+            variants = variants.limit(length)
+        data = variants_json(variants, sample, version, fields)
+    else:
+        # Criteria on the other columns need the serialized variants, with
+        # all the fields of their annotations: they are serialized by batches
+        # from a server-side cursor, only the requested page is kept
+        recordsFiltered = 0
+        data = list()
+        for batch in batches(variants.yield_per(STREAM_BATCH)):
+            for row in variants_json(batch, sample, version):
+                if not predicate(row):
                     continue
-                t[str(s)]= dict()
-                req = Var2Sample.query.get((var2sample.variant_ID, s.id))
-                if req:
-                    t[str(s)] = {
-                        "depth": f"{req.depth}",
-                        "allelic_depth": f"{req.allelic_depth}",
-                        "allelic_frequency": f"{(req.allelic_depth / req.depth):.4f}",
-                    }
-                else:
-                    t[str(s)] = {
-                        "depth": f"NA",
-                        "allelic_depth": f"NA",
-                        "allelic_frequency": f"NA",
-                    }
-
-            request_family = Sample.query.filter(
-                and_(
-                    Sample.familyid == sample.familyid,
-                    Sample.status >= 1,Sample.id != sample.id
-                )
-            ).outerjoin(Var2Sample)\
-                .filter(Var2Sample.variant_ID == var2sample.variant_ID)
-            for member in request_family:
-                members.append(member.samplename)
-
-        allelic_frequency = var2sample.allelic_depth / var2sample.depth
+                if recordsFiltered >= start and (length < 0 or len(data) < length):
+                    row["annotations"] = project_annotation(row["annotations"], fields)
+                    data.append(row)
+                recordsFiltered += 1
 
-        variants["data"].append({
-            "annotations": main_annot,
-            "chr": f"{variant.chr}",
-            "clinvar": {
-                "VARID" : variant.clinvar_VARID,
-                "CLNSIG" : variant.clinvar_CLNSIG,
-                "CLNSIGCONF" : variant.clinvar_CLNSIGCONF,
-                "CLNREVSTAT" : variant.clinvar_CLNREVSTAT
-            },
-            "id": f"{variant.id}",
-            "pos": f"{variant.pos}",
-            "ref": f"{variant.ref}",
-            "alt": f"{variant.alt}",
-            "filter": var2sample.filter,
-            "depth": f"{var2sample.depth}",
-            "reported": var2sample.reported,
-            "class_variant": variant.class_variant,
-            "allelic_depth": f"{var2sample.allelic_depth}",
-            "allelic_frequency": f"{allelic_frequency:.4f}",
-            "inseal": {
-                "occurrences": Var2Sample.query.filter(Var2Sample.variant == variant).count(),
-                "occurences_family": len(members),
-                "family_members": members
-            },
-            "phenotypes": phenotypes,
-            "family": t
-        })
-    return jsonify(variants)
+    return jsonify({
+        "draw": int(request.form["draw"]),
+        "recordsTotal": recordsTotal,
+        "recordsFiltered": recordsFiltered,
+        "revision": sample.revision,
+        "data": data
+    })
 
 
 @app.route("/json/transcripts", methods=['GET', 'POST'])
@@ -1380,18 +1919,13 @@ def json_bed(id):
             - stop: The position where the region stop.
             - name: The name of the region.
     """
-    bed = Bed.query.get(int(id))
-    data = list()
-    if not bed:
-        return jsonify({"data": data})
-    for region in bed.regions:
-        data.append({
-            "chr": region.chr,
-            "start": region.start,
-            "stop": region.stop,
-            "name": region.name,
-        })
-    return jsonify({"data": data})
+    regions = db.session.query(
+        Region.chr, Region.start, Region.stop, Region.name
+    ).join(region2bed).filter(region2bed.c.bed_ID == int(id))
+    return stream_json(
+        {"chr": chr, "start": start, "stop": stop, "name": name}
+        for chr, start, stop, name in regions.yield_per(STREAM_BATCH)
+    )
 
 
 @app.route("/json/history/<string:type>/<int:id>")
@@ -1417,22 +1951,43 @@ def json_history(type=None, id=None):
             - date: The date and time that the action was made
                     (formatted as "YYYY/MM/DD HH:MM:SS").
     """
+    historics = db.session.query(
+        User.username, Sample.samplename, History.action, History.date
+    ).join(User, History.user).join(Sample, History.sample)
     if type == "sample":
-        historics = History.query.filter_by(sample_ID= id)
+        historics = historics.filter(History.sample_ID == id)
     elif type == "user":
-        historics = History.query.filter_by(user_ID= id)
-    else:
-        historics = History.query.all()
-    historics_list = list()
-    for history in historics:
-        historics_list.append({
-            "user": history.user.username,
-            "sample": history.sample.samplename,
-            "action": history.action,
-            "date": history.date.strftime("%Y/%m/%d %H:%M:%S")
-        })
+        historics = historics.filter(History.user_ID == id)
+
+    return stream_json(
+        {
+            "user": username,
+            "sample": samplename,
+            "action": action,
+            "date": date.strftime("%Y/%m/%d %H:%M:%S")
+        }
+        for username, samplename, action, date in historics.yield_per(STREAM_BATCH)
+    )
 
-    return jsonify({"data":historics_list})
+
+@app.route("/json/imports")
+@login_required
+@admin_required
+def json_imports():
+    """
+    Endpoint for retrieving the status of the import jobs.
+
+    Returns:
+        A JSON object with the following keys:
+        - data: A list of dictionaries, each representing an import job
+            Each dictionary has the following keys:
+            - token: The name of the token of the job.
+            - samplename: The name of the sample imported.
+            - status: The status of the job ('waiting', 'running' or
+                      'error').
+    """
+    path_inout = Path(app.root_path).joinpath('static/temp/vcf/')
+    return jsonify({"data": get_import_jobs(path_inout)})
 
 
 @app.route("/json/variant/<string:id>")
@@ -1474,14 +2029,38 @@ def json_variant(id, version=-1, sample=None):
                                  sample.
             - reported: A boolean indicating whether the variant was reported
                         in the sample.
+        - occurrences: The occurrences of the variant in SEAL
+            - carriers: The number of samples with the variant.
+            - validated: The number of validated samples with the variant.
+            - affected: The number of affected samples with the variant.
+            - unaffected: The number of unaffected samples with the variant.
+            - teams: The number of samples with the variant by team.
         - comments: A list of dictionaries, each representing a comment
             Each dictionary has the following keys:
             - comment: The text of the comment.
             - date: The date and time that the comment was posted
                     (formatted as "YYYY/MM/DD HH:MM:SS").
             - user: The username of the user that have done the action.
+
+        Only the fields of the annotations listed in `fields` are read and
+        sent if given, see `annotation_fields`.
     """
-    variant = Variant.query.get(id)
+    fields = annotation_fields()
+    variants = Variant.query
+    if fields is not None and version == -1:
+        variants = variants.options(
+            defer(Variant.annotations),
+            with_expression(Variant.projected_version, Variant.projectedVersion(fields))
+        )
+    variant = variants.get(id)
+    if fields is not None and variant.projected_version is not None:
+        annotations = variant.projected_version
+    else:
+        annotations = variant.annotationVersion(version)
+        if fields is not None:
+            annotations = dict(annotations, ANN=[
+                project_annotation(annot, fields) for annot in annotations["ANN"]
+            ])
     if sample is not None:
         sample = Sample.query.get(sample)
 
@@ -1518,14 +2097,30 @@ def json_variant(id, version=-1, sample=None):
             "user": comment.user.username
         })
 
+    occurrence = variant.occurrence
+    occurrences = {
+        "carriers": occurrence.carriers if occurrence else 0,
+        "validated": occurrence.validated if occurrence else 0,
+        "affected": occurrence.affected if occurrence else 0,
+        "unaffected": occurrence.unaffected if occurrence else 0,
+        "teams": {
+            o.team.teamname: o.carriers
+            for o in Occurrence_team.query.filter(
+                Occurrence_team.variant_key == variant.key,
+                Occurrence_team.carriers > 0
+            )
+        }
+    }
+
     variant_json = {
         "id": variant.id,
         "chr": variant.chr,
         "pos": variant.pos,
         "ref": variant.ref,
         "alt": variant.alt,
-        "annotations": variant.annotations[version],
+        "annotations": annotations,
         "samples": samples,
+        "occurrences": occurrences,
         "comments": comments
     }
     return jsonify(variant_json)
@@ -1563,6 +2158,7 @@ def edit_name():
     history = History(sample_ID=sample_id, user_ID=current_user.id, date=datetime.now(), action=f"Sample rename : '{old_name}' -> '{sample.samplename}")
     db.session.add(history)
     db.session.commit()
+    invalidate_family(sample)
 
     return "ok"
 
@@ -1589,6 +2185,7 @@ def edit_family():
     sample_id = request.form["sample_id"]
     new_family = request.form["new_family"]
     sample = Sample.query.get(sample_id)
+    invalidate_family(sample)
 
     if not new_family:
         if sample.familyid:
@@ -1612,6 +2209,7 @@ def edit_family():
 
     db.session.add(history)
     db.session.commit()
+    invalidate_family(sample)
 
     return "ok"
 
@@ -1629,14 +2227,19 @@ def toggle_varStatus():
     Toggles the reported status of a variant to a sample.
 
     Returns:
-        str: The new reported status of the variant.
+        A JSON object with the variants changed since the revision held by
+        the client (`since`, default is the revision before the toggle), see
+        `variants_changes`.
     """
     id_var = request.form["id_var"]
     sample_id = request.form["sample_id"]
-    v2s = Var2Sample.query.get((id_var, sample_id))
+    v2s = Var2Sample.query.join(Variant, Var2Sample.variant).filter(
+        Variant.id == id_var, Var2Sample.sample_ID == sample_id).first()
+    since = request.form.get("since", v2s.sample.revision, type=int)
     v2s.reported = False if v2s.reported else True
-    return_value = v2s.reported
+    Var2Sample.touch(Var2Sample.sample_ID == v2s.sample_ID, Var2Sample.variant_key == v2s.variant_key)
     db.session.commit()
+    variants_cache.invalidate([v2s.sample_ID])
 
     report = "Report" if v2s.reported else "Unreport"
     history = History(
@@ -1647,7 +2250,10 @@ def toggle_varStatus():
     db.session.add(history)
     db.session.commit()
 
-    return f"{return_value}"
+    return jsonify(variants_changes(
+        v2s.sample, since, v2s.sample.bed_id,
+        fields=annotation_fields(app.config.get("VARIANTS_ANNOTATION_FIELDS"))
+    ))
 
 
 @app.route("/toggle/samples/variant/hide", methods=['POST'])
@@ -1657,14 +2263,19 @@ def toggle_varhide():
     Toggles the hide status of a variant to a sample.
 
     Returns:
-        str: The new hide status of the variant.
+        A JSON object with the variants changed since the revision held by
+        the client (`since`, default is the revision before the toggle), see
+        `variants_changes`.
     """
     id_var = request.form["id_var"]
     sample_id = request.form["sample_id"]
-    v2s = Var2Sample.query.get((id_var, sample_id))
+    v2s = Var2Sample.query.join(Variant, Var2Sample.variant).filter(
+        Variant.id == id_var, Var2Sample.sample_ID == sample_id).first()
+    since = request.form.get("since", v2s.sample.revision, type=int)
     v2s.hide = not v2s.hide
-    return_value = v2s.hide
+    Var2Sample.touch(Var2Sample.sample_ID == v2s.sample_ID, Var2Sample.variant_key == v2s.variant_key)
     db.session.commit()
+    variants_cache.invalidate([v2s.sample_ID])
 
     report = "Hide" if v2s.hide else "Show"
     history = History(
@@ -1675,7 +2286,10 @@ def toggle_varhide():
     db.session.add(history)
     db.session.commit()
 
-    return f"{return_value}"
+    return jsonify(variants_changes(
+        v2s.sample, since, v2s.sample.bed_id,
+        fields=annotation_fields(app.config.get("VARIANTS_ANNOTATION_FIELDS"))
+    ))
 
 
 @app.route("/toggle/samples/variant/hide/all", methods=['POST'])
@@ -1685,28 +2299,37 @@ def toggle_varhideall():
     Toggles the hide status of all variant to a sample.
 
     Returns:
-        str: The array of unhide variants
-    """
-    var_hide=list()
-    sample_id = request.form["sample_id"]
-    for v2s in Sample.query.get(sample_id).variants:
-        if not v2s.hide:
-            continue
-        v2s.hide = not v2s.hide
-        return_value = v2s.hide
-        var_hide.append(str(v2s))
-        db.session.commit()
-
-        report = "Hide" if v2s.hide else "Show"
+        A JSON object with the variants changed since the revision held by
+        the client (`since`, default is the revision before the toggle), see
+        `variants_changes`.
+    """
+    sample = Sample.query.get(request.form["sample_id"])
+    since = request.form.get("since", sample.revision, type=int)
+    hidden = Var2Sample.query.filter(
+        Var2Sample.sample_ID == sample.id,
+        Var2Sample.hide == True
+    ).all()
+    for v2s in hidden:
+        v2s.hide = False
+    if hidden:
+        # One entry for the whole toggle: the history is keyed by sample, user and date
         history = History(
-            sample_ID=sample_id,
+            sample_ID=sample.id,
             user_ID=current_user.id,
             date=datetime.now(),
-            action=f"{report} variant : {v2s.variant_ID}")
+            action=f"Show all variants : {len(hidden)} variants")
         db.session.add(history)
-        db.session.commit()
+        Var2Sample.touch(
+            Var2Sample.sample_ID == sample.id,
+            Var2Sample.variant_key.in_([v2s.variant_key for v2s in hidden])
+        )
+    db.session.commit()
+    variants_cache.invalidate([sample.id])
 
-    return f"{str(return_value)}"
+    return jsonify(variants_changes(
+        sample, since, sample.bed_id,
+        fields=annotation_fields(app.config.get("VARIANTS_ANNOTATION_FIELDS"))
+    ))
 
 
 @app.route("/toggle/sample/index", methods=['POST'])
@@ -1746,7 +2369,9 @@ def toggle_sampleAffected():
     sample_id = request.form["sample_id"]
     sample = Sample.query.get(sample_id)
     old = sample.affected
+    old_state = Occurrence.sample_state(sample)
     sample.affected = False if sample.affected else True
+    Occurrence.update_sample(sample, old_state)
 
     history = History(
         sample_ID=sample.id,
@@ -1811,11 +2436,7 @@ def toggle_samplePanel():
         db.session.add(history)
         db.session.commit()
 
-    count_hide=0
-
-    for v in  Var2Sample.query.filter(Var2Sample.sample_ID == sample.id, Var2Sample.hide == True):
-        if v.inBed():
-            count_hide+=1
+    count_hide = count_hidden(sample)
 
     return escape(count_hide)
 
@@ -1833,7 +2454,12 @@ def toggle_varClass():
     class_variant = request.form["class_variant"]
     variant = Variant.query.get(id_var)
     variant.class_variant = class_variant
+    Var2Sample.touch(Var2Sample.variant_key == variant.key)
     db.session.commit()
+    variants_cache.invalidate(
+        sample_id for sample_id, in db.session.query(Var2Sample.sample_ID).filter(
+            Var2Sample.variant_key == variant.key)
+    )
     return escape(f"{variant.class_variant}")
 
 
@@ -1850,13 +2476,16 @@ def toggle_sampleStatus():
     sample = Sample.query.get(sample_id)
     status = int(request.form["status"]) if "status" in request.form else False
     old_status = sample.status
+    old_state = Occurrence.sample_state(sample)
 
     if status:
         if not(status == 4 and not (current_user.biologist or current_user.admin)):
             sample.status = request.form["status"]
+            Occurrence.update_sample(sample, old_state)
             db.session.commit()
     elif sample.status == 1:
         sample.status = 2
+        Occurrence.update_sample(sample, old_state)
         db.session.commit()
 
     status_dict = {
@@ -1869,6 +2498,7 @@ def toggle_sampleStatus():
     }
 
     if sample.status != old_status:
+        invalidate_family(sample)
         history = History(
             sample_ID=sample.id,
             user_ID=current_user.id, date=datetime.now(),
@@ -1889,7 +2519,7 @@ def add_comment_variant():
     """
     comment = Comment_variant(
         comment=urllib.parse.unquote(request.form["comment"]),
-        variantid=request.form["id"],
+        variantkey=db.session.query(Variant.key).filter(Variant.id == request.form["id"]).scalar(),
         date=datetime.now(),
         userid=current_user.id)
     db.session.add(comment)
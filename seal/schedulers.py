@@ -18,24 +18,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import re
+import fcntl
+import gzip
 import json
+import shutil
 import time
 import numpy
 import random
 import subprocess
 from ftplib import FTP
 from pathlib import Path
+from itertools import chain
 from datetime import datetime
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from anacore import annotVcf
+from anacore.vcf import VCFIO
 
 from seal import app, scheduler, db
+from seal.cache import variants_cache
 from seal.models import (Sample, Variant, Family, Var2Sample, Run, Transcript,
-                         Team, Bed, Filter, History, Comment_sample, Clinvar)
+                         Team, Bed, Filter, History, Comment_sample, Clinvar,
+                         Clinvar_variant, Occurrence, Annotation)
 
-from sqlalchemy import exc
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 
 CONSEQUENCES_DICT = {
     "stop_gained": 20,
@@ -116,13 +127,62 @@ SPLICEAI = [
 ]
 
 
-def get_token(path_tokens):
-    for file in path_tokens.iterdir():
-        if file.suffix == '.token':
-            return file
+def claim_token(path_tokens):
+    """Claim the oldest token waiting to be imported.
+
+    The token is atomically renamed from `.token` to `.treat`, so a token can
+    only be claimed by one import worker, even across several processes.
+
+    Args:
+        path_tokens (Path): The directory containing the tokens.
+
+    Returns:
+        Path: The claimed `.treat` file, or False if no token is waiting.
+    """
+    tokens = sorted(path_tokens.glob('*.token'), key=lambda f: f.stat().st_mtime)
+    for token in tokens:
+        current_file = token.with_suffix('.treat')
+        try:
+            token.rename(current_file)
+        except FileNotFoundError:
+            continue
+        return current_file
     return False
 
 
+def get_import_jobs(path_tokens):
+    """List the import jobs and their status.
+
+    Args:
+        path_tokens (Path): The directory containing the tokens.
+
+    Returns:
+        list: A list of dictionaries, one per job, with the name of the token,
+              the samplename and the status of the job ('waiting', 'running'
+              or 'error').
+    """
+    status = {
+        '.token': 'waiting',
+        '.treat': 'running',
+        '.error': 'error'
+    }
+    jobs = list()
+    for file in path_tokens.iterdir():
+        if file.suffix not in status:
+            continue
+        try:
+            with file.open('r') as json_sample:
+                samplename = json.load(json_sample)["samplename"]
+        except (OSError, ValueError, KeyError):
+            samplename = None
+        jobs.append({
+            "token": file.stem,
+            "samplename": samplename,
+            "status": status[file.suffix]
+        })
+    return jobs
+
+
 def random_color(format="HEX"):
     red = random.randint(0, 255)
     green = random.randint(0, 255)
@@ -144,6 +204,23 @@ def is_valid_color(color):
     return bool(match_hex | match_rgb | match_rgba)
 
 
+def insert_missing(model, **values):
+    """
+    Insert a row unless one with the same unique value exists, without
+    failing when a concurrent import inserts it at the same time.
+
+    Args:
+        model: The model of the row.
+        **values: The values of the row.
+
+    Returns:
+        bool: True if the row was inserted.
+    """
+    result = db.session.execute(insert(model).values(**values).on_conflict_do_nothing())
+    db.session.commit()
+    return result.rowcount == 1
+
+
 def get_family(id=None, name=None):
     if id:
         family = Family.query.get(id)
@@ -153,12 +230,9 @@ def get_family(id=None, name=None):
         family = Family.query.filter_by(family=name).first()
         if bool(family):
             return family
-        else:
-            family = Family(family=name)
-            db.session.add(family)
-            db.session.commit()
-            app.logger.info(f'{family} added to SEAL !')
-            return family
+        if insert_missing(Family, family=name):
+            app.logger.info(f'{name} added to SEAL !')
+        return Family.query.filter_by(family=name).one()
     return False
 
 
@@ -174,12 +248,9 @@ def get_run(id=None, name=None, alias=None):
                 run.alias = alias
                 db.session.commit()
             return run
-        else:
-            run = Run(name=name, alias=alias)
-            db.session.add(run)
-            db.session.commit()
-            app.logger.info(f'{run} added to SEAL !')
-            return run
+        if insert_missing(Run, name=name, alias=alias):
+            app.logger.info(f'{name} added to SEAL !')
+        return Run.query.filter_by(name=name).one()
     return False
 
 
@@ -192,13 +263,10 @@ def get_team(id=None, name=None, color=None):
         team = Team.query.filter_by(teamname=name).first()
         if bool(team):
             return team
-        else:
-            color = color if is_valid_color(color) else random_color()
-            team = Team(teamname=name, color=color)
-            db.session.add(team)
-            db.session.commit()
-            app.logger.info(f'{team} added to SEAL !')
-            return team
+        color = color if is_valid_color(color) else random_color()
+        if insert_missing(Team, teamname=name, color=color):
+            app.logger.info(f'{name} added to SEAL !')
+        return Team.query.filter_by(teamname=name).one()
     return False
 
 
@@ -379,246 +447,808 @@ def create_and_execute_shell_command(json_file, values):
     return exit_code, output
 
 
+def format_annotations(annotations, current_date, transcripts):
+    """Format the VEP annotations of a variant as stored in SEAL.
+
+    Args:
+        annotations (list): The list of VEP annotations (one per transcript).
+        current_date (str): The date of the annotation version.
+        transcripts (dict): A dictionary of transcripts (by feature) filled
+                            with the transcripts found in the annotations.
+
+    Returns:
+        tuple: A tuple containing the annotation versions of the variant and
+               a dictionary of the ClinVar fields.
+    """
+    formatted = [{
+        "date": current_date,
+        "ANN": list()
+    }]
+    clinvar = dict()
+
+    for annot in annotations:
+        clinvar = {
+            "clinvar_VARID": annot["ClinVar"],
+            "clinvar_CLNSIG": annot["ClinVar_CLNSIG"],
+            "clinvar_CLNSIGCONF": ''.join(annot["ClinVar_CLNSIGCONF"].split("&")) if annot["ClinVar_CLNSIGCONF"] else None,
+            "clinvar_CLNREVSTAT": ''.join(annot["ClinVar_CLNREVSTAT"].split("&")) if annot["ClinVar_CLNREVSTAT"] else None
+        }
+        # Split annotations
+        for splitAnn in ANNOT_TO_SPLIT:
+            if splitAnn == 'VAR_SYNONYMS':
+                try:
+                    var_synonyms = dict()
+                    for vs in annot[splitAnn].split("--"):
+                        key, values = vs.split("::")
+                        values_array = values.split("&")
+                        var_synonyms[key] = values_array
+
+                    annot[splitAnn] = var_synonyms
+                except AttributeError:
+                    annot[splitAnn] = dict()
+            else:
+                try:
+                    annot[splitAnn] = annot[splitAnn].split("&")
+                except AttributeError:
+                    annot[splitAnn] = []
+
+        # transcript
+        if annot["Feature"] is not None and annot["Feature"] not in transcripts:
+            transcripts[annot["Feature"]] = {
+                "feature": annot["Feature"],
+                "biotype": annot["BIOTYPE"],
+                "feature_type": annot["Feature_type"],
+                "symbol": annot["SYMBOL"],
+                "symbol_source": annot["SYMBOL_SOURCE"],
+                "gene": annot["Gene"],
+                "source": annot["SOURCE"],
+                "protein": annot["ENSP"],
+                "canonical": annot["CANONICAL"],
+                "hgnc": annot["HGNC_ID"]
+            }
+
+        # Get consequence score
+        consequence_score = 0
+        for consequence in annot["Consequence"]:
+            consequence_score += CONSEQUENCES_DICT[consequence]
+        annot["consequenceScore"] = consequence_score
+
+        # Get Exon/Intron
+        annot["EI"] = None
+        if annot["EXON"] is not None:
+            annot["EI"] = f"{annot['EXON']}"
+        if annot["INTRON"] is not None:
+            annot["EI"] = f"{annot['INTRON']}"
+
+        # Get Exon/Intron
+        annot["canonical"] = True if annot['CANONICAL'] == 'YES' else False
+
+        formatted[-1]["ANN"].append(annot)
+    formatted[-1]["main"] = select_main_annotation(formatted[-1]["ANN"])
+    return formatted, clinvar
+
+
+def select_main_annotation(annotations):
+    """Select the main annotation of a variant, without user preferences:
+    RefSeq first, then protein coding, canonical and with the most severe
+    consequence.
+
+    Args:
+        annotations (list): The annotations (one per transcript) of a
+                            version, formatted by `format_annotations`.
+
+    Returns:
+        int: The index of the main annotation, None if there is none.
+    """
+    main = None
+    for idx, annot in enumerate(annotations):
+        if main is None:
+            main = idx
+            continue
+        best = annotations[main]
+
+        refseq = best['SOURCE'] == 'RefSeq'
+        current_refseq = annot['SOURCE'] == 'RefSeq'
+        if refseq != current_refseq:
+            if current_refseq:
+                main = idx
+            continue
+
+        protein_coding = best['BIOTYPE'] == 'protein_coding'
+        current_protein_coding = annot['BIOTYPE'] == 'protein_coding'
+        if current_protein_coding and not protein_coding:
+            main = idx
+            continue
+        if protein_coding and not current_protein_coding:
+            continue
+
+        if best['canonical'] and not annot['canonical']:
+            continue
+        if not best['canonical'] and annot['canonical']:
+            main = idx
+            continue
+
+        if annot['consequenceScore'] > best['consequenceScore']:
+            main = idx
+    return main
+
+
+def to_json_values(array):
+    """Convert a numpy array to a list of floats, non-finite values to None.
+
+    Args:
+        array (numpy.ndarray): A 1D array of floats.
+
+    Returns:
+        list: A list of floats or None.
+    """
+    return [value if numpy.isfinite(value) else None for value in array.tolist()]
+
+
+def derive_scores(annotations):
+    """Compute the derived scores of many VEP annotations at once.
+
+    The missense mean, the max SpliceAI and the MaxEntScan variation are
+    computed on matrices holding all the annotations instead of one numpy
+    allocation per annotation.
+
+    Args:
+        annotations (list): The VEP annotations (one per transcript), updated
+                            in place with `missensesMean`, `spliceAI` and
+                            `MES_var`.
+    """
+    if not annotations:
+        return
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        # missense
+        missenses = numpy.array(
+            [[annot[value] for value in MISSENSES] for annot in annotations],
+            dtype=numpy.float64)
+        count = numpy.count_nonzero(~numpy.isnan(missenses), axis=1)
+        means = numpy.nansum(missenses, axis=1) / count
+
+        # max spliceAI
+        spliceAI = numpy.array(
+            [[annot[value] for value in SPLICEAI] for annot in annotations],
+            dtype=numpy.float64)
+        maxs = numpy.fmax.reduce(spliceAI, axis=1)
+
+        # max MaxEntScan
+        maxentscan = numpy.array(
+            [[annot["MaxEntScan_alt"], annot["MaxEntScan_ref"]] for annot in annotations],
+            dtype=numpy.float64)
+        mes_var = -100 + (maxentscan[:, 0] * 100) / maxentscan[:, 1]
+
+    for annot, mean, max, mes in zip(annotations, to_json_values(means),
+                                     to_json_values(maxs),
+                                     to_json_values(mes_var)):
+        annot["missensesMean"] = mean
+        annot["spliceAI"] = max
+        annot["MES_var"] = mes
+
+
+def add_duplicate(sample, user_id, variant_id):
+    """Keep a trace of a variant found twice for the same sample.
+
+    Args:
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+        variant_id (str): The ID of the duplicated variant.
+    """
+    app.logger.info(f"Duplicate variant for {sample} : {variant_id}")
+    history = History(
+        sample_ID=sample.id,
+        user_ID=user_id,
+        date=datetime.now(),
+        action=f"Duplicate variant : {variant_id}")
+    db.session.add(history)
+    comment = Comment_sample(
+        comment=f"Duplicate variant : {variant_id}",
+        sampleid=sample.id,
+        date=datetime.now(),
+        userid=user_id)
+    db.session.add(comment)
+
+
+def import_chunk(records, sample, user_id, current_date):
+    """Write a chunk of VCF records of a sample into the database.
+
+    Variants and transcripts already in SEAL are resolved with one query per
+    chunk, the new ones are written with multi-row `INSERT ... ON CONFLICT`
+    statements, with the typed rows of their annotations (see `Annotation`),
+    and the whole chunk is committed at once.
+
+    Args:
+        records (dict): The VEP annotated VCF records, by variant ID.
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+        current_date (str): The date of the annotation version.
+    """
+    annotated = {
+        id for id, in db.session.query(Variant.id).filter(
+            Variant.id.in_(list(records)),
+            Variant.annotations.isnot(None))
+    }
+
+    variants = list()
+    transcripts = dict()
+    chunk_annotations = list()
+    for id, v in records.items():
+        if id not in annotated:
+            annotations, clinvar = format_annotations(v.info["ANN"], current_date, transcripts)
+            chunk_annotations.extend(annotations[-1]["ANN"])
+            variants.append({
+                "id": id,
+                "chr": f"chr{v.chrom.replace('chr','')}",
+                "pos": v.pos,
+                "ref": v.ref,
+                "alt": v.alt[0],
+                "annotations": annotations,
+                "clinvar_VARID": clinvar.get("clinvar_VARID"),
+                "clinvar_CLNSIG": clinvar.get("clinvar_CLNSIG"),
+                "clinvar_CLNSIGCONF": clinvar.get("clinvar_CLNSIGCONF"),
+                "clinvar_CLNREVSTAT": clinvar.get("clinvar_CLNREVSTAT")
+            })
+    derive_scores(chunk_annotations)
+
+    if transcripts:
+        existing = {
+            feature for feature, in db.session.query(Transcript.feature).filter(
+                Transcript.feature.in_(list(transcripts)))
+        }
+        new_transcripts = [t for f, t in transcripts.items() if f not in existing]
+        if new_transcripts:
+            stmt = insert(Transcript.__table__).values(new_transcripts)
+            db.session.execute(stmt.on_conflict_do_nothing(index_elements=["feature"]))
+
+    if variants:
+        # Rows locked in the same order by concurrent imports, not to deadlock
+        variants.sort(key=lambda variant: variant["id"])
+        stmt = insert(Variant.__table__).values(variants)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                "annotations": stmt.excluded.annotations,
+                "clinvar_VARID": stmt.excluded.clinvar_VARID,
+                "clinvar_CLNSIG": stmt.excluded.clinvar_CLNSIG,
+                "clinvar_CLNSIGCONF": stmt.excluded.clinvar_CLNSIGCONF,
+                "clinvar_CLNREVSTAT": stmt.excluded.clinvar_CLNREVSTAT
+            },
+            where=Variant.__table__.c.annotations.is_(None)
+        )
+        db.session.execute(stmt)
+
+    keys = variant_keys(list(records))
+    if variants:
+        Annotation.insert(list(chain.from_iterable(
+            Annotation.rows(keys[variant["id"]], variant["annotations"]) for variant in variants
+        )))
+
+    insert_var2samples(records, keys, sample, user_id)
+    db.session.commit()
+
+
+def import_known_variants(vcf_path, vcf_novel, sample, user_id):
+    """Import the variants of a sample already annotated in SEAL.
+
+    The records of the VCF are looked up by chunks. The variants already
+    annotated are linked to the sample directly, the other records are written
+    to a new VCF which is the only one to be annotated with VEP.
+
+    Args:
+        vcf_path (Path): The VCF file of the sample.
+        vcf_novel (Path): The VCF file of the records to annotate.
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+
+    Returns:
+        int: The number of records written in `vcf_novel`.
+    """
+    novel = 0
+    with VCFIO(vcf_path) as vcf_io, VCFIO(vcf_novel, "w") as writer:
+        writer.copyHeader(vcf_io)
+        writer.writeHeader()
+        for chunk in batch_records(vcf_io, sample, user_id):
+            novel += import_known_chunk(chunk, sample, user_id, writer)
+    return novel
+
+
+def import_known_chunk(records, sample, user_id, writer):
+    """Link a chunk of VCF records already annotated in SEAL to a sample.
+
+    Args:
+        records (dict): The VCF records of the sample, by variant ID.
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+        writer (VCFIO): The VCF where the records to annotate are written.
+
+    Returns:
+        int: The number of records written in `writer`.
+    """
+    annotated = dict(
+        db.session.query(Variant.id, Variant.key).filter(
+            Variant.id.in_(list(records)),
+            Variant.annotations.isnot(None))
+    )
+
+    novel = 0
+    known = dict()
+    for id, v in records.items():
+        if id in annotated:
+            known[id] = v
+        else:
+            writer.write(v)
+            novel += 1
+
+    if known:
+        insert_var2samples(known, annotated, sample, user_id)
+    db.session.commit()
+    return novel
+
+
+def batch_records(vcf_io, sample, user_id):
+    """Read the records of a VCF by chunks of `IMPORT_CHUNK_SIZE` variants.
+
+    Only one chunk of records is held in memory at a time. A variant found
+    twice in the same chunk is traced as a duplicate and yielded once.
+
+    Args:
+        vcf_io (VCFIO): The VCF to read.
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+
+    Yields:
+        dict: A chunk of VCF records, by variant ID.
+    """
+    chunk_size = app.config.get("IMPORT_CHUNK_SIZE", 1000)
+    chunk = dict()
+    for v in vcf_io:
+        if v.alt[0] == "*":
+            continue
+        id = get_variant_id(v)
+        if id in chunk:
+            add_duplicate(sample, user_id, id)
+            continue
+        chunk[id] = v
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = dict()
+    if chunk:
+        yield chunk
+
+
+def get_variant_id(record):
+    """Get the SEAL ID of a VCF record (`chr-pos-ref-alt`).
+
+    Args:
+        record (VCFRecord): The VCF record.
+
+    Returns:
+        str: The ID of the variant.
+    """
+    return f"chr{record.chrom.replace('chr','')}-{record.pos}-{record.ref}-{record.alt[0]}"
+
+
+def variant_keys(ids):
+    """Get the keys of variants from their SEAL IDs, with one query.
+
+    Args:
+        ids (list): The IDs of the variants.
+
+    Returns:
+        dict: The keys of the variants found, by ID.
+    """
+    return dict(db.session.query(Variant.id, Variant.key).filter(Variant.id.in_(ids)))
+
+
+def get_var2sample(record, key, sample):
+    """Get the `Var2Sample` row of a VCF record.
+
+    Args:
+        record (VCFRecord): The VCF record.
+        key (int): The key of the variant.
+        sample (Sample): The sample of the record.
+
+    Returns:
+        dict: The values of the `Var2Sample` row.
+    """
+    return {
+        "variant_key": key,
+        "sample_ID": sample.id,
+        "depth": record.getPopDP(),
+        "allelic_depth": record.getPopAltAD()[0],
+        "filter": record.filter,
+        "reported": False,
+        "hide": False
+    }
+
+
+def insert_var2samples(records, keys, sample, user_id):
+    """Insert the `Var2Sample` rows of VCF records of a sample with one
+    statement.
+
+    Args:
+        records (dict): The VCF records, by variant ID.
+        keys (dict): The keys of the variants, by ID.
+        sample (Sample): The sample being imported.
+        user_id (int): The ID of the user importing the sample.
+    """
+    var2samples = [get_var2sample(v, keys[id], sample) for id, v in records.items()]
+    # If duplicate variant for sample, add to history & comments
+    stmt = insert(Var2Sample.__table__).values(var2samples)
+    stmt = stmt.on_conflict_do_nothing().returning(Var2Sample.__table__.c.variant_key)
+    inserted = {key for key, in db.session.execute(stmt)}
+    for id in records:
+        if keys[id] not in inserted:
+            add_duplicate(sample, user_id, id)
+    if inserted:
+        Occurrence.count_sample(sample, variant_keys=list(inserted))
+
+
+def run_vep(values):
+    """Run VEP on a VCF file, retrying it if it fails.
+
+    Args:
+        values (dict): A dictionary of values to be used to replace
+                       placeholders in the VEP command arguments.
+
+    Returns:
+        tuple: A tuple containing the exit code and output of the command.
+
+    Raises:
+        CommandFailedError: If VEP still fails after `VEP_RETRY` retries.
+    """
+    retries = app.config.get("VEP_RETRY", 2)
+    for attempt in range(retries + 1):
+        try:
+            return create_and_execute_shell_command(Path(app.root_path).joinpath('static/vep.config.json'), values)
+        except CommandFailedError:
+            if attempt >= retries:
+                raise
+            app.logger.warning(f"VEP failed on {values['vcf_path']} (attempt {attempt + 1}/{retries + 1}), retry")
+
+
+def split_vcf(vcf_path, path_shards, shard_size):
+    """Split a VCF file into shards with a fixed number of records.
+
+    Args:
+        vcf_path (Path): The VCF file to split (can be gzipped).
+        path_shards (Path): The directory where the shards are written.
+        shard_size (int): The number of records per shard.
+
+    Returns:
+        list: The paths of the shards, in the order of the records.
+    """
+    opener = gzip.open if vcf_path.suffix == ".gz" else open
+    header = list()
+    shards = list()
+    shard = None
+    count = 0
+    with opener(vcf_path, "rt") as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                header.append(line)
+                continue
+            if count % shard_size == 0:
+                if shard:
+                    shard.close()
+                shards.append(path_shards.joinpath(f"shard_{len(shards):05d}.vcf"))
+                shard = open(shards[-1], "w")
+                shard.writelines(header)
+            shard.write(line)
+            count += 1
+    if shard:
+        shard.close()
+    return shards
+
+
+def merge_vcf(vcf_parts, vcf_path):
+    """Concatenate VCF files, keeping only the header of the first one.
+
+    Args:
+        vcf_parts (list): The VCF files to merge, in order.
+        vcf_path (Path): The merged VCF file.
+    """
+    with open(vcf_path, "w") as merged:
+        for i, part in enumerate(vcf_parts):
+            with open(part, "r") as vcf:
+                for line in vcf:
+                    if i > 0 and line.startswith("#"):
+                        continue
+                    merged.write(line)
+
+
+def annotate_vcf(values):
+    """Annotate a VCF file with VEP.
+
+    The VCF is split into shards of `VEP_SHARD_SIZE` records annotated by up to
+    `VEP_PARALLEL` concurrent VEP processes, each shard being retried on
+    failure. The annotated shards are then merged back in order.
+
+    Args:
+        values (dict): A dictionary of values to be used to replace
+                       placeholders in the VEP command arguments.
+
+    Raises:
+        CommandFailedError: If VEP fails on a shard.
+    """
+    vcf_path = Path(values["vcf_path"])
+    # The VCF to annotate is named after the import token, unique
+    path_shards = vcf_path.parent.joinpath(f'{vcf_path.stem}.shards')
+    path_shards.mkdir(exist_ok=True)
+    try:
+        shards = split_vcf(vcf_path, path_shards, app.config.get("VEP_SHARD_SIZE", 50000))
+        if len(shards) <= 1:
+            run_vep(values)
+            return
+
+        shards_values = [
+            dict(values,
+                 vcf_path=shard,
+                 vcf_vep=shard.with_suffix('.vep.vcf'),
+                 stats_vep=shard.with_suffix('.vep.html'))
+            for shard in shards
+        ]
+        app.logger.info(f"  - {len(shards)} shards")
+        with ThreadPoolExecutor(max_workers=app.config.get("VEP_PARALLEL", 4)) as executor:
+            list(executor.map(run_vep, shards_values))
+        merge_vcf([v["vcf_vep"] for v in shards_values], values["vcf_vep"])
+    finally:
+        shutil.rmtree(path_shards)
+
+
+import_executor = ThreadPoolExecutor(
+    max_workers=app.config.get("IMPORT_WORKERS", 4),
+    thread_name_prefix="importvcf"
+)
+import_jobs = set()
+
+
 # cron examples
 @scheduler.task('cron', id='import vcf', second="*/20")
 def importvcf():
-    # Check launchable
+    """Dispatch the waiting tokens to the pool of import workers."""
     path_inout = Path(app.root_path).joinpath('static/temp/vcf/')
-    current_token = get_token(path_inout)
-    path_locker = path_inout.joinpath('.lock')
 
-    if current_token and not path_locker.exists():
-        app.logger.info("---------------- Create A New Sample ----------------")
+    import_jobs.difference_update([job for job in import_jobs if job.done()])
+    while len(import_jobs) < app.config.get("IMPORT_WORKERS", 4):
+        current_file = claim_token(path_inout)
+        if not current_file:
+            break
+        import_jobs.add(import_executor.submit(import_sample, current_file))
 
-        # Create lock file
-        lockFile = open(path_locker, 'x')
-        lockFile.close()
 
-        # Change token to treat file
-        current_file = current_token.with_suffix('.treat')
-        current_token.rename(current_file)
+@contextmanager
+def clinvar_lock(shared):
+    """Lock the current ClinVar release, across threads and processes.
 
-        # Load data
-        with current_file.open('r') as json_sample:
-            data = json.load(json_sample)
+    The imports hold it shared, from the annotation of their variants with
+    the current ClinVar VCF to their insertion. The switch to a new release
+    (files and variants) holds it exclusively, so an import annotates and
+    inserts all its variants with one release.
 
-        # Check user
+    Args:
+        shared (bool): True for a shared lock, False for an exclusive one.
+    """
+    path_lock = Path(app.root_path).joinpath('static/temp/clinvar/.current.lock')
+    with open(path_lock, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
         try:
-            user_id = data["userid"]
-        except KeyError:
-            user_id = 1
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
-        try:
-            date_import = data["date"]
-        except KeyError:
-            date_import = datetime.now()
 
-        try:
-            genome = data["genome"]
-        except KeyError:
-            genome = "grch37"
+def import_sample(current_file):
+    """Import a sample from a claimed token, and log its status.
 
-        # Come from interface
-        try:
-            interface = data["interface"]
-        except KeyError:
-            interface = False
+    Args:
+        current_file (Path): The `.treat` file describing the sample.
+    """
+    try:
+        with clinvar_lock(shared=True):
+            import_token(current_file)
+    except Exception as e:
+        app.logger.exception(f"Import failed for {current_file} : {e}")
+        db.session.rollback()
+        if current_file.exists():
+            current_file.rename(current_file.with_suffix('.error'))
+    finally:
+        # The occurrences shown with the variants of the other samples changed
+        variants_cache.invalidate()
+        db.session.remove()
 
-        vcf_path = Path(data["vcf_path"])
-        if not vcf_path.exists():
-            app.logger.error(f'Path does not exist for : {vcf_path}')
-            return
 
-        sample = create_sample(data)
+def discard_import(sample):
+    """Mark a sample whose import failed as in error, and remove the variants
+    already imported, from the occurrences too.
+
+    Args:
+        sample (Sample): The sample.
+    """
+    db.session.rollback()
+    Occurrence.count_sample(sample, sign=-1)
+    Var2Sample.query.filter_by(sample_ID=sample.id).delete(synchronize_session=False)
+    sample.status = -1
+    db.session.commit()
+
+
+def import_token(current_file):
+    """Annotate the VCF of a claimed token with VEP and import it.
+
+    Args:
+        current_file (Path): The `.treat` file describing the sample.
+    """
+    path_inout = current_file.parent
+    app.logger.info(f"---------------- Create A New Sample ({current_file.stem}) ----------------")
+
+    # Load data
+    with current_file.open('r') as json_sample:
+        data = json.load(json_sample)
+
+    # Check user
+    try:
+        user_id = data["userid"]
+    except KeyError:
+        user_id = 1
+
+    try:
+        date_import = data["date"]
+    except KeyError:
+        date_import = datetime.now()
+
+    try:
+        genome = data["genome"]
+    except KeyError:
+        genome = "grch37"
+
+    # Come from interface
+    try:
+        interface = data["interface"]
+    except KeyError:
+        interface = False
+
+    vcf_path = Path(data["vcf_path"])
+    if not vcf_path.exists():
+        app.logger.error(f'Path does not exist for : {vcf_path}')
+        current_file.rename(current_file.with_suffix('.error'))
+        return
+
+    sample = create_sample(data)
+    try:
         history = History(sample_ID=sample.id, user_ID=user_id, date=date_import, action=f"Import Sample")
         db.session.add(history)
         db.session.commit()
 
-        vcf_vep = path_inout.joinpath(f'{vcf_path.stem}.vep.vcf')
-        stats_vep = path_inout.joinpath(f'{vcf_path.stem}.vep.html')
+        # Named after the token, unique, as concurrent imports can have VCFs of
+        # the same name
+        vcf_novel = path_inout.joinpath(f'{current_file.stem}.novel.vcf')
+        vcf_vep = path_inout.joinpath(f'{current_file.stem}.vep.vcf')
+        stats_vep = path_inout.joinpath(f'{current_file.stem}.vep.html')
         clinvar_vcf = Path(app.root_path).joinpath(f'static/temp/clinvar/{genome}/current.vcf.gz')
 
         values = {
-            "vcf_path": vcf_path,
+            "vcf_path": vcf_novel,
             "vcf_vep": vcf_vep,
             "stats_vep": stats_vep,
             "ClinVar_vcf": clinvar_vcf
         }
 
-        current_date = datetime.now().isoformat()
-        try:
-            app.logger.info("------ Variant Annotation with VEP ------")
-            create_and_execute_shell_command(Path(app.root_path).joinpath('static/vep.config.json'), values)
-            app.logger.info("------ END VEP ------")
-        except CommandFailedError as e:
-            app.logger.info(f"{type(e).__name__} : {e}")
-            sample.status = -1
-            path_locker.unlink()
-            db.session.commit()
-            error_file = current_file.with_suffix('.error')
-            current_file.rename(error_file)
-            return
-
-        with annotVcf.AnnotVCFIO(vcf_vep) as vcf_io:
-            for v in vcf_io:
-                if v.alt[0] == "*":
-                    continue
-                variant = Variant.query.get(f"chr{v.chrom.replace('chr','')}-{v.pos}-{v.ref}-{v.alt[0]}")
-                if not variant:
-                    variant = Variant(
-                        id=f"chr{v.chrom.replace('chr','')}-{v.pos}-{v.ref}-{v.alt[0]}",
-                        chr=f"chr{v.chrom.replace('chr','')}",
-                        pos=v.pos,
-                        ref=v.ref,
-                        alt=v.alt[0])
-                    db.session.add(variant)
-
-                if not variant.annotations:
-                    annotations = [{
-                        "date": current_date,
-                        "ANN": list()
-                    }]
-
-                    for annot in v.info["ANN"]:
-                        variant.clinvar_VARID = annot["ClinVar"]
-                        variant.clinvar_CLNSIG = annot["ClinVar_CLNSIG"]
-                        variant.clinvar_CLNSIGCONF = ''.join(annot["ClinVar_CLNSIGCONF"].split("&")) if annot["ClinVar_CLNSIGCONF"] else None
-                        variant.clinvar_CLNREVSTAT = ''.join(annot["ClinVar_CLNREVSTAT"].split("&")) if annot["ClinVar_CLNREVSTAT"] else None
-                        # Split annotations
-                        for splitAnn in ANNOT_TO_SPLIT:
-                            if splitAnn == 'VAR_SYNONYMS':
-                                try:
-                                    var_synonyms = dict()
-                                    for vs in annot[splitAnn].split("--"):
-                                        key, values = vs.split("::")
-                                        values_array = values.split("&")
-                                        var_synonyms[key] = values_array
-
-                                    annot[splitAnn] = var_synonyms
-                                except AttributeError:
-                                    annot[splitAnn] = dict()
-                            else:
-                                try:
-                                    annot[splitAnn] = annot[splitAnn].split("&")
-                                except AttributeError:
-                                    annot[splitAnn] = []
-
-                        # transcript
-                        transcript = Transcript.query.get(annot["Feature"])
-                        if not transcript and annot["Feature"] is not None:
-                            transcript = Transcript(
-                                feature=annot["Feature"],
-                                biotype=annot["BIOTYPE"],
-                                feature_type=annot["Feature_type"],
-                                symbol=annot["SYMBOL"],
-                                symbol_source=annot["SYMBOL_SOURCE"],
-                                gene=annot["Gene"],
-                                source=annot["SOURCE"],
-                                protein=annot["ENSP"],
-                                canonical=annot["CANONICAL"],
-                                hgnc=annot["HGNC_ID"]
-                            )
-                            db.session.add(transcript)
-
-                        # Get consequence score
-                        consequence_score = 0
-                        for consequence in annot["Consequence"]:
-                            consequence_score += CONSEQUENCES_DICT[consequence]
-                        annot["consequenceScore"] = consequence_score
-
-                        # Get Exon/Intron
-                        annot["EI"] = None
-                        if annot["EXON"] is not None:
-                            annot["EI"] = f"{annot['EXON']}"
-                        if annot["INTRON"] is not None:
-                            annot["EI"] = f"{annot['INTRON']}"
-
-                        # Get Exon/Intron
-                        annot["canonical"] = True if annot['CANONICAL'] == 'YES' else False
-
-                        # missense
-                        missenses = list()
-                        for value in MISSENSES:
-                            missenses.append(annot[value])
-                        missenses = numpy.array(missenses, dtype=numpy.float64)
-                        mean = numpy.nanmean(missenses)
-                        annot["missensesMean"] = None if numpy.isnan(mean) else mean
-
-                        # max spliceAI
-                        spliceAI = list()
-                        for value in SPLICEAI:
-                            spliceAI.append(annot[value])
-                        spliceAI = numpy.array(spliceAI, dtype=numpy.float64)
-                        max = numpy.nanmax(spliceAI)
-                        annot["spliceAI"] = None if numpy.isnan(max) else max
-
-                        # max MaxEntScan
-                        annot["MES_var"] = None
-                        if (annot["MaxEntScan_alt"] is not None
-                                and annot["MaxEntScan_ref"] is not None):
-                            annot["MES_var"] = -100 + (float(annot["MaxEntScan_alt"]) * 100) / float(annot["MaxEntScan_ref"])
-
-                        annotations[-1]["ANN"].append(annot)
-                    variant.annotations = annotations
-
-                # If duplicate variant for sample :
-                #   - catch exception
-                #   - add to history & comments
-                try:
-                    v2s = Var2Sample(
-                        variant_ID=variant.id,
-                        sample_ID=sample.id,
-                        depth=v.getPopDP(),
-                        allelic_depth=v.getPopAltAD()[0],
-                        filter=v.filter)
-                    db.session.add(v2s)
-                    db.session.commit()
-                except exc.IntegrityError as e:
-                    db.session.rollback()
-                    app.logger.info(f"{type(e).__name__} : {e}")
-                    history = History(
-                        sample_ID=sample.id,
-                        user_ID=user_id,
-                        date=datetime.now(),
-                        action=f"{type(e).__name__}")
-                    db.session.add(history)
-                    comment = Comment_sample(
-                        comment=f"{type(e).__name__} : {e}",
-                        sampleid=sample.id,
-                        date=datetime.now(),
-                        userid=user_id)
-                    db.session.add(comment)
-                    db.session.commit
+        app.logger.info("------ Variants already annotated ------")
+        novel = import_known_variants(vcf_path, vcf_novel, sample, user_id)
+        app.logger.info(f"  - {novel} variants to annotate")
+
+        if novel:
+            current_date = datetime.now().isoformat()
+            try:
+                app.logger.info("------ Variant Annotation with VEP ------")
+                annotate_vcf(values)
+                app.logger.info("------ END VEP ------")
+            except CommandFailedError as e:
+                app.logger.info(f"{type(e).__name__} : {e}")
+                discard_import(sample)
+                error_file = current_file.with_suffix('.error')
+                current_file.rename(error_file)
+                vcf_novel.unlink()
+                return
+
+            with annotVcf.AnnotVCFIO(vcf_vep) as vcf_io:
+                for chunk in batch_records(vcf_io, sample, user_id):
+                    import_chunk(chunk, sample, user_id, current_date)
+            vcf_vep.unlink()
+            if stats_vep.exists():
+                stats_vep.unlink()
 
-        path_locker.unlink()
-        db.session.commit()
-        current_file.unlink()
-        vcf_vep.unlink()
-        stats_vep.unlink()
-        if interface:
-            vcf_path.unlink()
-        history = History(
-            sample_ID=sample.id,
-            user_ID=user_id,
-            date=datetime.now(),
-            action=f"Sample Imported")
-        db.session.add(history)
-        sample.status = 1
         db.session.commit()
+    except Exception:
+        discard_import(sample)
+        raise
+
+    current_file.unlink()
+    vcf_novel.unlink()
+    if interface:
+        vcf_path.unlink()
+    history = History(
+        sample_ID=sample.id,
+        user_ID=user_id,
+        date=datetime.now(),
+        action=f"Sample Imported")
+    db.session.add(history)
+    sample.status = 1
+    db.session.commit()
+    app.logger.info(f"---------------- Sample Imported ({current_file.stem}) ----------------")
+
+
+def copy_value(value):
+    """Format a value for the text format of PostgreSQL `COPY`.
+
+    Args:
+        value: The value to format.
+
+    Returns:
+        str: The formatted value (`\\N` for None).
+    """
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_clinvar(cursor, vcf_io, chunk_size=100000):
+    """Load the records of a ClinVar VCF into `clinvar_staging` with `COPY`.
+
+    The records are sent by chunks so that memory does not grow with the
+    size of ClinVar.
+
+    Args:
+        cursor: A DB-API cursor on the transaction holding `clinvar_staging`.
+        vcf_io (AnnotVCFIO): The ClinVar VCF.
+        chunk_size (int): The number of records sent by `COPY`.
+
+    Returns:
+        int: The number of records loaded.
+    """
+    cpt = 0
+    buffer = io.StringIO()
+    for v in vcf_io:
+        row = [
+            get_variant_id(v),
+            v.id,
+            ''.join(v.info["CLNSIG"]) if "CLNSIG" in v.info else None,
+            ''.join(v.info["CLNSIGCONF"]) if "CLNSIGCONF" in v.info else None,
+            ''.join(v.info["CLNREVSTAT"]) if "CLNREVSTAT" in v.info else None
+        ]
+        buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+        cpt += 1
+        if cpt % chunk_size == 0:
+            buffer.seek(0)
+            cursor.copy_expert("COPY clinvar_staging FROM STDIN", buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert("COPY clinvar_staging FROM STDIN", buffer)
+    return cpt
 
 
 def update_clinvar_thread(vcf, version, genome="grch37"):
+    """Load a new ClinVar release and switch SEAL to it.
+
+    The release is loaded in the background as a new version of
+    `Clinvar_variant`, the variants keep their current ClinVar data meanwhile.
+    The variants and the `current` flag are then switched to the new version
+    in a single transaction, so no maintenance window is needed.
+
+    Args:
+        vcf (str): The path of the ClinVar VCF.
+        version (int): The version of the ClinVar release.
+        genome (str): The genome version of the ClinVar release.
+    """
     # Check and create locker
-    path_locker = Path(app.root_path).joinpath('static/temp/vcf/.lock')
+    path_locker = Path(app.root_path).joinpath('static/temp/clinvar/.lock')
     while path_locker.exists():
         time.sleep(1)
     lockFile = open(path_locker, 'x')
     lockFile.close()
 
-    # Switch on maintenance mode
-    app.config["MAINTENANCE"] = True
-    app.config["MAINTENANCE_REASON"] = "Update ClinVar"
-
     # Define paths
     new_clinvar = Path(vcf)
     new_clinvar_index = Path(f"{new_clinvar}.tbi")
@@ -630,48 +1260,77 @@ def update_clinvar_thread(vcf, version, genome="grch37"):
     db.session.add(clinvar)
     db.session.commit()
 
-    # Try to update
+    # Try to load the new version
     try:
-        cpt = 0
         execute_shell_command(["tabix", "-p", "vcf", new_clinvar])
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('''
+            CREATE TEMPORARY TABLE clinvar_staging (
+                id text,
+                "VARID" integer,
+                "CLNSIG" text,
+                "CLNSIGCONF" text,
+                "CLNREVSTAT" text
+            ) ON COMMIT DROP
+        ''')
         with annotVcf.AnnotVCFIO(new_clinvar) as vcf_io:
-            for v in vcf_io:
-                cpt += 1
-                variant = Variant.query.get(f"chr{v.chrom.replace('chr','')}-{v.pos}-{v.ref}-{v.alt[0]}")
-                if variant:
-                    variant.clinvar_VARID = v.id
-                    variant.clinvar_CLNSIG = ''.join(v.info["CLNSIG"]) if "CLNSIG" in v.info else None
-                    variant.clinvar_CLNSIGCONF = ''.join(v.info["CLNSIGCONF"]) if "CLNSIGCONF" in v.info else None
-                    variant.clinvar_CLNREVSTAT = ''.join(v.info["CLNREVSTAT"]) if "CLNREVSTAT" in v.info else None
+            cpt = copy_clinvar(cursor, vcf_io)
+        app.logger.info(f"  - {cpt} ClinVar records loaded")
+        cursor.execute('''
+            INSERT INTO clinvar_variant (version, "variant_ID", "VARID", "CLNSIG", "CLNSIGCONF", "CLNREVSTAT")
+            SELECT DISTINCT ON (id) %s, id, "VARID", "CLNSIG", "CLNSIGCONF", "CLNREVSTAT"
+            FROM clinvar_staging
+            ON CONFLICT DO NOTHING
+        ''', (version, ))
+        db.session.commit()
     except Exception as e:
         db.session.rollback()
         path_log = Path(app.root_path).joinpath('static/temp/clinvar/error')
         with open(path_log, "w") as log:
             log.write(f"Error on file: {new_clinvar}")
-            log.write(e)
-        app.config["MAINTENANCE"] = False
-        del app.config["MAINTENANCE_REASON"]
+            log.write(str(e))
         path_locker.unlink()
         return
 
-    # Update Clinvar
-    for c in Clinvar.query.filter_by(genome=genome, current=True).all():
-        c.current = False
-    clinvar.current = True
+    # Switch variants, current version and files at once, between imports
+    with clinvar_lock(shared=False):
+        previous = [c.version for c in Clinvar.query.filter_by(genome=genome, current=True)]
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('''
+            UPDATE variant
+            SET "clinvar_VARID" = c."VARID",
+                "clinvar_CLNSIG" = c."CLNSIG",
+                "clinvar_CLNSIGCONF" = c."CLNSIGCONF",
+                "clinvar_CLNREVSTAT" = c."CLNREVSTAT"
+            FROM clinvar_variant c
+            WHERE c.version = %s
+              AND variant.id = c."variant_ID"
+              AND ("clinvar_VARID", "clinvar_CLNSIG", "clinvar_CLNSIGCONF", "clinvar_CLNREVSTAT")
+                  IS DISTINCT FROM (c."VARID", c."CLNSIG", c."CLNSIGCONF", c."CLNREVSTAT")
+        ''', (version, ))
+        app.logger.info(f"  - {cursor.rowcount} variants updated")
+        for c in Clinvar.query.filter_by(genome=genome, current=True).all():
+            c.current = False
+        clinvar.current = True
+        db.session.commit()
+        variants_cache.invalidate()
+        new_clinvar.rename(current)
+        new_clinvar_index.rename(current_index)
+
+    # Keep only the current and the previous versions
+    outdated = select(Clinvar.version).where(
+        Clinvar.genome == genome,
+        Clinvar.version.notin_(previous + [version]))
+    Clinvar_variant.query.filter(Clinvar_variant.version.in_(outdated))\
+        .delete(synchronize_session=False)
     db.session.commit()
-    new_clinvar.rename(current)
-    new_clinvar_index.rename(current_index)
 
-    # Switch off maintenance mode
-    app.config["MAINTENANCE"] = False
-    del app.config["MAINTENANCE_REASON"]
     path_locker.unlink()
 
 
 @scheduler.task('cron', id='update clinvar', day_of_week="mon")
 def check_clinvar(genome="GRCh37"):
-    path_inout = Path(app.root_path).joinpath('static/temp/vcf/')
-    path_locker = path_inout.joinpath('.lock')
+    path_locker = Path(app.root_path).joinpath('static/temp/clinvar/.lock')
     app.logger.info("START CLINVAR UPDATE")
 
     while path_locker.exists():
@@ -555,7 +555,18 @@ $(document).ready(function() {
             style:    'os',
             selector: 'td:not(:nth-child(2), :nth-child(' + (11 + number_family) + '), :nth-child(' + (12 + number_family) + '), :nth-last-child(-n+3))'
         },
-        ajax: json_variants,
+        serverSide: server_side,
+        ajax: {
+            url: json_variants,
+            type: server_side ? 'POST' : 'GET',
+            headers: {
+                'X-CSRF-TOKEN': csrf_token
+            },
+            dataSrc: function(json) {
+                revision = json.revision;
+                return json.data;
+            }
+        },
         columns: dt_table,
         initComplete: function(settings, json) {
             changeFilter(sample_filter_id, sample_id);
@@ -863,10 +874,12 @@ function hideRow(id_var, sample_id, item) {
                 url: "/toggle/samples/variant/hide",
                 data: {
                     id_var: id_var,
-                    sample_id: sample_id
+                    sample_id: sample_id,
+                    since: revision
                 },
-                success: function() {
+                success: function(changes) {
                     $('#tableHistorySample').DataTable().ajax.reload();
+                    patch_variants(changes);
                 }
             })
         }
@@ -874,23 +887,37 @@ function hideRow(id_var, sample_id, item) {
 }
 
 function showAllRows() {
-    $('#variants').DataTable()
-        .clear()
-        .draw();
     $.ajax({
         type: "POST",
         url: "/toggle/samples/variant/hide/all",
         data: {
-            sample_id: sample_id
+            sample_id: sample_id,
+            since: revision
         },
-        success: function() {
+        success: function(changes) {
             $('#tableHistorySample').DataTable().ajax.reload();
-            $('#variants').DataTable().ajax.reload();
+            patch_variants(changes);
         }
     })
     hide_message(0);
 }
 
+function patch_variants(changes) {
+    // Replace the rows changed since the revision of the table, instead of
+    // reloading all the variants
+    var table = $('#variants').DataTable();
+    if (server_side) {
+        table.draw(false);
+        return;
+    }
+    var ids = changes.removed.concat(changes.data.map(variant => variant.id));
+    table.rows(function(idx, data) {
+        return ids.includes(data.id);
+    }).remove();
+    table.rows.add(changes.data).draw(false);
+    revision = changes.revision;
+}
+
 function save_filters() {
     var d = table.searchBuilder.getDetails();
     $('#filterText').html(JSON.stringify(d));
@@ -1726,14 +1753,11 @@ function toggle_var2sample_status(id, id_var, sample_id, type, self) {
         type: "POST",
         url: "/toggle/samples/variant/status",
         data: {
-            "id_var": id_var, "sample_id": sample_id, "type":type
+            "id_var": id_var, "sample_id": sample_id, "type":type, "since": revision
         },
-        success: function() {
+        success: function(changes) {
             $('#tableHistorySample').DataTable().ajax.reload();
-            var cell = $('#variants').DataTable().cell(self.closest('td'))
-            var data = cell.data();
-            data["reported"]=!cell.data()["reported"];
-            cell.data(data).draw();
+            patch_variants(changes);
         }
     })
 }